@@ -0,0 +1,410 @@
+from pymongo import ASCENDING, ReturnDocument, ReplaceOne, UpdateOne
+import random
+from datetime import datetime
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from almacenamiento import (
+    COLECCIONES_POR_REGISTRO,
+    COLECCIONES_HISTORIAL,
+    INDICES,
+    LOTE_HISTORIAL,
+    Coleccion,
+    copiar_registro,
+    particiones_historial,
+)
+
+# Registros que mover_registros pasa de una colección a otra en cada transacción
+LOTE_MOVER = 1000
+
+class AlmacenMongo:
+    """Almacenamiento sobre MongoDB"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def coleccion(self, nombre):
+        """Devuelve la referencia a una colección"""
+        return Coleccion(nombre, self)
+
+    def ping(self):
+        """Verifica la conexión con el servidor"""
+        self.db.client.admin.command('ping')
+
+    def _en_transaccion(self, operacion):
+        """Ejecuta una operación dentro de una transacción de MongoDB"""
+        with self.db.client.start_session() as sesion:
+            return sesion.with_transaction(operacion)
+
+    # Migración e índices
+
+    def migrar(self):
+        """Migra los arreglos únicos a un documento por registro y el historial a particiones"""
+        for nombre, campo in COLECCIONES_POR_REGISTRO.items():
+            migrados = self._migrar_documento_unico(nombre, campo)
+            if migrados:
+                print(f"Migrados {migrados} registros de {nombre}.{campo}")
+            if campo == 'usuarios':
+                self._eliminar_duplicados(nombre, 'chat_id')
+
+        for nombre, tipo in COLECCIONES_HISTORIAL.items():
+            migrados = self._migrar_historial(nombre, tipo)
+            if migrados:
+                print(f"Migradas {migrados} particiones de {nombre}")
+
+        self.crear_indices()
+
+    def crear_indices(self):
+        """Crea los índices de INDICES (lo único que necesita main.py al arrancar)"""
+        # El pool no repite códigos (índice único); las bases anteriores podían tenerlos repetidos
+        eliminados = self._eliminar_duplicados('codigos_pool', 'codigo')
+        if eliminados:
+            print(f"Eliminados {eliminados} códigos repetidos de codigos_pool")
+
+        for nombre, indices in INDICES.items():
+            existentes = self.db[nombre].index_information()
+            for campos, unico in indices:
+                if campos == ('_id',):
+                    continue  # MongoDB ya indexa _id
+                claves = [(c, ASCENDING) for c in campos]
+                for indice, opciones in existentes.items():
+                    if opciones['key'] == claves and bool(opciones.get('unique')) != unico:
+                        # El índice cambió de único a no único o al revés: se vuelve a crear
+                        self.db[nombre].drop_index(indice)
+                self.db[nombre].create_index(claves, unique=unico)
+
+    def _migrar_documento_unico(self, nombre, campo):
+        """Convierte el documento único {campo: [...]} en un documento por registro"""
+        coleccion = self.db[nombre]
+
+        def operacion(sesion):
+            # Se lee y se borra dentro de la transacción: si otro proceso ya migró el
+            # documento (o la transacción se reintenta) no se borra nada ni se inserta
+            legado = coleccion.find_one({campo: {'$type': 'array'}}, session=sesion)
+            if legado is None:
+                return None
+            if coleccion.delete_one({'_id': legado['_id']}, session=sesion).deleted_count == 0:
+                return 0
+            registros = [copiar_registro(r) for r in legado[campo] if isinstance(r, dict)]
+            if registros:
+                coleccion.insert_many(registros, session=sesion)
+            return len(registros)
+
+        migrados = 0
+        while True:
+            resultado = self._en_transaccion(operacion)
+            if resultado is None:
+                return migrados
+            migrados += resultado
+
+    def _eliminar_duplicados(self, nombre, campo):
+        """Deja un solo registro por valor de `campo` (el más reciente) antes de crear el índice único"""
+        coleccion = self.db[nombre]
+        duplicados = coleccion.aggregate([
+            {'$sort': {'_id': ASCENDING}},
+            {'$group': {'_id': f'${campo}', 'ids': {'$push': '$_id'}, 'total': {'$sum': 1}}},
+            {'$match': {'total': {'$gt': 1}}}
+        ])
+        eliminados = 0
+        for grupo in duplicados:
+            eliminados += coleccion.delete_many({'_id': {'$in': grupo['ids'][:-1]}}).deleted_count
+        return eliminados
+
+    def _migrar_historial(self, nombre, tipo):
+        """Convierte el documento {'historial': {fecha: [...]}} en particiones por sorteo"""
+        coleccion = self.db[nombre]
+
+        def operacion(sesion):
+            # Igual que en _migrar_documento_unico: leer y borrar antes de insertar
+            legado = coleccion.find_one({'historial': {'$exists': True}}, session=sesion)
+            if legado is None:
+                return None
+            if coleccion.delete_one({'_id': legado['_id']}, session=sesion).deleted_count == 0:
+                return 0
+            historial = legado['historial'] if isinstance(legado['historial'], dict) else {}
+            particiones = []
+            for fecha, registros in historial.items():
+                if isinstance(registros, list):
+                    particiones.extend(particiones_historial(tipo, fecha, registros))
+            if particiones:
+                coleccion.insert_many(particiones, session=sesion)
+            return len(particiones)
+
+        migrados = 0
+        while True:
+            resultado = self._en_transaccion(operacion)
+            if resultado is None:
+                return migrados
+            migrados += resultado
+
+    # Documentos únicos
+
+    def cargar_documento(self, nombre):
+        return self.db[nombre].find_one({}, {'_id': 0})
+
+    def insertar_documento(self, nombre, documento):
+        self.db[nombre].insert_one(documento)
+
+    def actualizar_documento_si_version(self, nombre, cambios, version):
+        # Los documentos anteriores al control de versión no tienen el campo
+        filtro = {'version': version} if version else {'version': {'$in': [0, None]}}
+        resultado = self.db[nombre].update_one(filtro, {'$set': dict(cambios, version=version + 1)})
+        return resultado.matched_count == 1
+
+    def guardar_documento(self, nombre, documento):
+        coleccion = self.db[nombre]
+        coleccion.delete_many({})
+        coleccion.insert_one(documento)
+
+    def vaciar(self, nombre):
+        self.db[nombre].delete_many({})
+
+    # Registros
+
+    def cargar_registros(self, nombre, filtro=None):
+        return list(self.db[nombre].find(filtro or {}, {'_id': 0}).sort('_id', ASCENDING))
+
+    def cargar_valores(self, nombre, campo):
+        # Solo viaja el campo pedido, no el documento entero
+        documentos = self.db[nombre].find({campo: {'$ne': None}}, {campo: 1, '_id': 0})
+        return [d[campo] for d in documentos if campo in d]
+
+    def agregar_registro(self, nombre, registro):
+        self.db[nombre].insert_one(registro)
+
+    def agregar_sin_repetir(self, nombre, registros):
+        try:
+            return len(self.db[nombre].insert_many(registros, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            # Los que violan un índice único se descartan; cualquier otro error sigue
+            if any(error['code'] != 11000 for error in e.details.get('writeErrors', [])):
+                raise
+            return e.details['nInserted']
+
+    def insertar_si_no_existe(self, nombre, registro):
+        try:
+            self.db[nombre].insert_one(registro)
+            return True
+        except DuplicateKeyError:
+            # Viola un índice único
+            return False
+
+    def agregar_registros(self, nombre, registros):
+        self.db[nombre].insert_many(registros)
+
+    def actualizar_registro_si_version(self, nombre, filtro, cambios, version):
+        # Los registros anteriores al control de versión no tienen el campo
+        condicion = {'version': version} if version else {'version': {'$in': [0, None]}}
+        resultado = self.db[nombre].update_one(dict(filtro, **condicion), {'$set': dict(cambios, version=version + 1)})
+        return resultado.matched_count == 1
+
+    def contar_registros(self, nombre, filtro=None):
+        return self.db[nombre].count_documents(filtro or {})
+
+    def reemplazar_registros(self, nombre, registros):
+        coleccion = self.db[nombre]
+
+        def operacion(sesion):
+            coleccion.delete_many({}, session=sesion)
+            if registros:
+                coleccion.insert_many(registros, session=sesion)
+
+        self._en_transaccion(operacion)
+
+    def mover_registros(self, nombre, destino, filtro):
+        """Mueve los registros por _id de LOTE_MOVER en LOTE_MOVER, cada lote en su transacción"""
+        coleccion = self.db[nombre]
+
+        def operacion(sesion):
+            registros = list(coleccion.find(filtro, session=sesion).sort('_id', ASCENDING).limit(LOTE_MOVER))
+            if registros:
+                self.db[destino].insert_many(registros, session=sesion)
+                coleccion.delete_many({'_id': {'$in': [r['_id'] for r in registros]}}, session=sesion)
+            return len(registros)
+
+        movidos = 0
+        while True:
+            cantidad = self._en_transaccion(operacion)
+            movidos += cantidad
+            if cantidad < LOTE_MOVER:
+                return movidos
+
+    def actualizar_estado_comprobante(self, nombre, comprobante_id, estado, estado_anterior=None):
+        filtro = {'comprobante_id': comprobante_id}
+        if estado_anterior is not None:
+            # Solo se aplica la transición si nadie más la aplicó antes
+            filtro['estado'] = estado_anterior
+        return self.db[nombre].find_one_and_update(
+            filtro,
+            {'$set': {'estado': estado}},
+            projection={'_id': 0},
+            return_document=ReturnDocument.AFTER
+        )
+
+    def buscar_usuario(self, nombre, chat_id):
+        return self.db[nombre].find_one({'chat_id': chat_id}, {'_id': 0})
+
+    def guardar_usuario(self, nombre, usuario):
+        self.db[nombre].replace_one({'chat_id': usuario['chat_id']}, usuario, upsert=True)
+
+    # Códigos en espera
+
+    def liberar_codigos(self, nombre_usados, nombre_pool, ahora):
+        usados = self.db[nombre_usados]
+
+        def operacion(sesion):
+            # Solo se leen los que vencen (índice liberar_en)
+            vencidos = list(usados.find({'liberar_en': {'$lte': ahora}}, {'codigo': 1}, session=sesion))
+            if not vencidos:
+                return []
+            codigos = [v['codigo'] for v in vencidos]
+            # Un código que ya está en el pool no se repite (índice único de codigo)
+            resultado = self.db[nombre_pool].bulk_write(
+                [UpdateOne({'codigo': c}, {'$setOnInsert': {'aleatorio': random.random()}}, upsert=True)
+                 for c in codigos], session=sesion)
+            usados.delete_many({'_id': {'$in': [v['_id'] for v in vencidos]}}, session=sesion)
+            return [codigos[indice] for indice in sorted(resultado.upserted_ids)]
+
+        return self._en_transaccion(operacion)
+
+    def reclamar_aleatorio(self, nombre, punto):
+        coleccion = self.db[nombre]
+        # El primero a partir de un punto al azar; si no hay, se da la vuelta al inicio
+        for filtro in ({'aleatorio': {'$gte': punto}}, {}):
+            documento = coleccion.find_one_and_delete(filtro, sort=[('aleatorio', ASCENDING)])
+            if documento is not None:
+                return documento['codigo']
+        return None
+
+    def programar_codigos(self, nombre_pool, nombre_programados, nombre_usados, huecos, punto):
+        pool, programados = self.db[nombre_pool], self.db[nombre_programados]
+
+        def operacion(sesion):
+            # Los días ya programados se leen en una sola consulta
+            dias = sorted({h['dia'] for h in huecos})
+            ocupados = {(p['pagina'], p['dia']) for p in programados.find(
+                {'dia': {'$in': dias}}, {'pagina': 1, 'dia': 1, '_id': 0}, session=sesion)}
+            pendientes = [h for h in huecos if (h['pagina'], h['dia']) not in ocupados]
+            if not pendientes:
+                # limit(0) no limita: sin este corte se sacarían del pool todos los códigos
+                return []
+            # Una racha de códigos a partir de un punto al azar, dando la vuelta si no alcanza
+            elegidos = list(pool.find({'aleatorio': {'$gte': punto}}, {'codigo': 1}, session=sesion)
+                            .sort('aleatorio', ASCENDING).limit(len(pendientes)))
+            if len(elegidos) < len(pendientes):
+                elegidos += list(pool.find({'aleatorio': {'$lt': punto}}, {'codigo': 1}, session=sesion)
+                                 .sort('aleatorio', ASCENDING).limit(len(pendientes) - len(elegidos)))
+            if not elegidos:
+                return []
+
+            nuevos = [{'pagina': h['pagina'], 'dia': h['dia'], 'codigo': e['codigo']}
+                      for h, e in zip(pendientes, elegidos)]
+            pool.delete_many({'_id': {'$in': [e['_id'] for e in elegidos]}}, session=sesion)
+            programados.insert_many([dict(n) for n in nuevos], session=sesion)
+            self.db[nombre_usados].insert_many(
+                [{'codigo': n['codigo'], 'fecha': h['dia'], 'liberar_en': h['liberar_en']}
+                 for h, n in zip(pendientes, nuevos)], session=sesion)
+            return nuevos
+
+        try:
+            return self._en_transaccion(operacion)
+        except DuplicateKeyError:
+            # Otro proceso programó los mismos días a la vez; sus códigos quedan
+            return []
+
+    # Contadores
+
+    def reservar_secuencia(self, nombre, contador, cantidad):
+        documento = self.db[nombre].find_one_and_update(
+            {'_id': contador},
+            {'$inc': {'valor': cantidad}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return documento['valor']
+
+    def incrementar_contadores(self, nombre, cambios):
+        # Todos los $inc en un solo viaje al servidor
+        self.db[nombre].bulk_write(
+            [UpdateOne({'_id': c}, {'$inc': {'valor': n}}, upsert=True) for c, n in cambios.items()], ordered=False)
+
+    def leer_contadores(self, nombre, contadores):
+        return {d['_id']: d['valor'] for d in self.db[nombre].find({'_id': {'$in': list(contadores)}})}
+
+    def fijar_contador(self, nombre, contador, valor):
+        self.db[nombre].update_one({'_id': contador}, {'$set': {'valor': valor}}, upsert=True)
+
+    # Escrituras diferidas
+
+    def aplicar_escrituras(self, preparar, secuencia):
+        """Aplica un lote de la cola de escritura y marca su secuencia en una sola transacción.
+
+        `preparar(aplicada)` devuelve los grupos de operaciones posteriores a la
+        secuencia ya aplicada, que se lee dentro de la transacción: si el lote ya
+        estaba guardado (reintento o reaplicación del diario) no se repite nada.
+        """
+        def operacion(sesion):
+            marca = self.db.cola_escritura.find_one({'_id': 'aplicada'}, session=sesion)
+            aplicada = marca['secuencia'] if marca else 0
+            if aplicada >= secuencia:
+                return
+            for tipo, nombre, datos in preparar(aplicada):
+                coleccion = self.db[nombre]
+                if tipo == 'agregar_registro':
+                    # Copias: insert_many agrega _id y un reintento debe partir de cero
+                    coleccion.insert_many([dict(r) for r in datos], session=sesion)
+                elif tipo == 'guardar_usuario':
+                    coleccion.bulk_write(
+                        [ReplaceOne({'chat_id': u['chat_id']}, u, upsert=True) for u in datos], session=sesion)
+                elif tipo == 'actualizar_estado_comprobante':
+                    coleccion.bulk_write(
+                        [UpdateOne({'comprobante_id': d['comprobante_id']}, {'$set': {'estado': d['estado']}})
+                         for d in datos], session=sesion)
+                elif tipo == 'incrementar_contador':
+                    coleccion.bulk_write(
+                        [UpdateOne({'_id': d['contador']}, {'$inc': {'valor': d['cantidad']}}, upsert=True)
+                         for d in datos], session=sesion)
+                else:
+                    raise ValueError(f"Operación no soportada: {tipo}")
+            self.db.cola_escritura.update_one(
+                {'_id': 'aplicada'}, {'$max': {'secuencia': secuencia}}, upsert=True, session=sesion)
+
+        self._en_transaccion(operacion)
+
+    def secuencia_aplicada(self):
+        """Última secuencia de la cola de escritura que ya está guardada"""
+        documento = self.db.cola_escritura.find_one({'_id': 'aplicada'})
+        return documento['secuencia'] if documento else 0
+
+    # Historial
+
+    def cargar_particiones(self, nombre):
+        return self.db[nombre].find({}, {'_id': 0, 'fecha': 1, 'registros': 1}).sort(
+            [('fecha', ASCENDING), ('_id', ASCENDING)])
+
+    def archivar_registros(self, nombre, destino, tipo, fecha):
+        """Mueve los registros a particiones del historial recorriéndolos con un cursor, en una transacción"""
+        origen = self.db[nombre]
+
+        def operacion(sesion):
+            creado = datetime.now()
+            movidos = 0
+            registros, ids = [], []
+
+            def guardar_particion():
+                self.db[destino].insert_one(
+                    {'tipo': tipo, 'fecha': fecha, 'creado': creado, 'registros': registros}, session=sesion)
+                origen.delete_many({'_id': {'$in': ids}}, session=sesion)
+
+            cursor = origen.find({}, session=sesion).sort('_id', ASCENDING).batch_size(LOTE_HISTORIAL)
+            for registro in cursor:
+                ids.append(registro.pop('_id'))
+                registros.append(registro)
+                if len(registros) == LOTE_HISTORIAL:
+                    guardar_particion()
+                    movidos += len(registros)
+                    registros, ids = [], []
+            if registros:
+                guardar_particion()
+                movidos += len(registros)
+            return movidos
+
+        return self._en_transaccion(operacion)
@@ -0,0 +1,409 @@
+import re
+import random
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from almacenamiento import (
+    COLECCIONES_POR_REGISTRO,
+    COLECCIONES_HISTORIAL,
+    INDICES,
+    LOTE_HISTORIAL,
+    Coleccion,
+    a_json,
+    de_json,
+)
+
+# Solo se aceptan nombres simples para tablas y campos (se insertan en el SQL)
+_NOMBRE_VALIDO = re.compile(r'^\w+$')
+
+def _campo(campo):
+    """Expresión SQL de un campo del documento (igual a la usada en los índices)"""
+    if not _NOMBRE_VALIDO.match(campo):
+        raise ValueError(f"Nombre de campo no válido: {campo}")
+    return f"json_extract(doc, '$.{campo}')"
+
+def _condicion(campo, valor):
+    """Condición de igualdad de un campo; las fechas se guardan como objeto JSON"""
+    if isinstance(valor, datetime):
+        return f"{_campo(campo)} = json(?)", a_json(valor)
+    return f"{_campo(campo)} = ?", valor
+
+def _donde(filtro):
+    """Construye la cláusula WHERE para un filtro de igualdad {campo: valor}"""
+    if not filtro:
+        return '', []
+    condiciones = [_condicion(campo, valor) for campo, valor in filtro.items()]
+    return ' WHERE ' + ' AND '.join(c for c, _ in condiciones), [v for _, v in condiciones]
+
+class AlmacenSQLite:
+    """Almacenamiento local sobre SQLite en modo WAL.
+
+    Cada colección es una tabla (id, doc) donde doc es el documento en JSON;
+    los índices se crean sobre expresiones json_extract de los campos.
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._local = threading.local()
+        self._tablas = set()
+        self._tablas_lock = threading.Lock()
+        self._conexion().execute('PRAGMA journal_mode=WAL')
+
+    def _conexion(self):
+        """Devuelve la conexión del hilo actual (sqlite3 no comparte conexiones entre hilos)"""
+        conexion = getattr(self._local, 'conexion', None)
+        if conexion is None:
+            conexion = sqlite3.connect(self.ruta, timeout=30, isolation_level=None)
+            conexion.execute('PRAGMA synchronous=NORMAL')
+            conexion.execute('PRAGMA busy_timeout=30000')
+            self._local.conexion = conexion
+        return conexion
+
+    @contextmanager
+    def _transaccion(self):
+        """Agrupa varias sentencias en una transacción de escritura"""
+        conexion = self._conexion()
+        conexion.execute('BEGIN IMMEDIATE')
+        try:
+            yield conexion
+        except Exception:
+            conexion.execute('ROLLBACK')
+            raise
+        conexion.execute('COMMIT')
+
+    def _tabla(self, nombre):
+        """Crea la tabla y sus índices la primera vez que se usa y devuelve su nombre"""
+        if nombre in self._tablas:
+            return f'"{nombre}"'
+        if not _NOMBRE_VALIDO.match(nombre):
+            raise ValueError(f"Nombre de colección no válido: {nombre}")
+
+        with self._tablas_lock:
+            conexion = self._conexion()
+            conexion.execute(
+                f'CREATE TABLE IF NOT EXISTS "{nombre}" (id INTEGER PRIMARY KEY AUTOINCREMENT, doc TEXT NOT NULL)')
+            existentes = {fila[1]: bool(fila[2]) for fila in conexion.execute(f'PRAGMA index_list("{nombre}")')}
+            for campos, unico in INDICES.get(nombre, []):
+                indice = f'ix_{nombre}_{"_".join(campos)}'
+                if existentes.get(indice, unico) != unico:
+                    # El índice cambió de único a no único o al revés: se vuelve a crear
+                    conexion.execute(f'DROP INDEX "{indice}"')
+                columnas = ", ".join(_campo(c) for c in campos)
+                crear = (f'CREATE {"UNIQUE " if unico else ""}INDEX IF NOT EXISTS '
+                         f'"{indice}" ON "{nombre}" ({columnas})')
+                try:
+                    conexion.execute(crear)
+                except sqlite3.IntegrityError:
+                    # Datos anteriores al índice único: se deja el más reciente de cada valor
+                    # (en SQLite los NULL no chocan en un índice único, así que no se tocan)
+                    con_valor = " AND ".join(f"{_campo(c)} IS NOT NULL" for c in campos)
+                    eliminados = conexion.execute(
+                        f'DELETE FROM "{nombre}" WHERE {con_valor} AND id NOT IN '
+                        f'(SELECT MAX(id) FROM "{nombre}" GROUP BY {columnas})').rowcount
+                    print(f"Eliminados {eliminados} registros repetidos de {nombre} para crear su índice único")
+                    conexion.execute(crear)
+            self._tablas.add(nombre)
+        return f'"{nombre}"'
+
+    def coleccion(self, nombre):
+        """Devuelve la referencia a una colección"""
+        self._tabla(nombre)
+        return Coleccion(nombre, self)
+
+    def ping(self):
+        """Verifica que la base de datos responde"""
+        self._conexion().execute('SELECT 1')
+
+    def migrar(self):
+        """Crea las tablas e índices de todas las colecciones conocidas"""
+        for nombre in list(COLECCIONES_POR_REGISTRO) + list(COLECCIONES_HISTORIAL):
+            self._tabla(nombre)
+        self.crear_indices()
+
+    def crear_indices(self):
+        """Crea las tablas con índices de INDICES (lo único que necesita main.py al arrancar)"""
+        for nombre in INDICES:
+            self._tabla(nombre)
+
+    # Documentos únicos
+
+    def cargar_documento(self, nombre):
+        fila = self._conexion().execute(f'SELECT doc FROM {self._tabla(nombre)} ORDER BY id LIMIT 1').fetchone()
+        return de_json(fila[0]) if fila else None
+
+    def insertar_documento(self, nombre, documento):
+        self._conexion().execute(f'INSERT INTO {self._tabla(nombre)} (doc) VALUES (?)', (a_json(documento),))
+
+    def actualizar_documento_si_version(self, nombre, cambios, version):
+        tabla = self._tabla(nombre)
+        with self._transaccion() as conexion:
+            fila = conexion.execute(f'SELECT id, doc FROM {tabla} ORDER BY id LIMIT 1').fetchone()
+            if fila is None:
+                return False
+            documento = de_json(fila[1])
+            if documento.get('version', 0) != version:
+                return False
+            documento.update(cambios, version=version + 1)
+            conexion.execute(f'UPDATE {tabla} SET doc = ? WHERE id = ?', (a_json(documento), fila[0]))
+            return True
+
+    def guardar_documento(self, nombre, documento):
+        tabla = self._tabla(nombre)
+        with self._transaccion() as conexion:
+            conexion.execute(f'DELETE FROM {tabla}')
+            conexion.execute(f'INSERT INTO {tabla} (doc) VALUES (?)', (a_json(documento),))
+
+    def vaciar(self, nombre):
+        self._conexion().execute(f'DELETE FROM {self._tabla(nombre)}')
+
+    # Registros
+
+    def cargar_registros(self, nombre, filtro=None):
+        donde, parametros = _donde(filtro)
+        filas = self._conexion().execute(
+            f'SELECT doc FROM {self._tabla(nombre)}{donde} ORDER BY id', parametros).fetchall()
+        return [de_json(fila[0]) for fila in filas]
+
+    def cargar_valores(self, nombre, campo):
+        filas = self._conexion().execute(
+            f'SELECT {_campo(campo)} FROM {self._tabla(nombre)} WHERE {_campo(campo)} IS NOT NULL').fetchall()
+        return [fila[0] for fila in filas]
+
+    def agregar_registro(self, nombre, registro):
+        self.insertar_documento(nombre, registro)
+
+    def agregar_registros(self, nombre, registros):
+        tabla = self._tabla(nombre)
+        with self._transaccion() as conexion:
+            conexion.executemany(f'INSERT INTO {tabla} (doc) VALUES (?)', [(a_json(r),) for r in registros])
+
+    def agregar_sin_repetir(self, nombre, registros):
+        tabla = self._tabla(nombre)
+        with self._transaccion() as conexion:
+            # Los que violan un índice único se descartan
+            return conexion.executemany(
+                f'INSERT OR IGNORE INTO {tabla} (doc) VALUES (?)', [(a_json(r),) for r in registros]).rowcount
+
+    def insertar_si_no_existe(self, nombre, registro):
+        try:
+            self.insertar_documento(nombre, registro)
+            return True
+        except sqlite3.IntegrityError:
+            # Viola un índice único
+            return False
+
+    def actualizar_registro_si_version(self, nombre, filtro, cambios, version):
+        tabla = self._tabla(nombre)
+        donde, parametros = _donde(filtro)
+        with self._transaccion() as conexion:
+            fila = conexion.execute(f'SELECT id, doc FROM {tabla}{donde} ORDER BY id LIMIT 1', parametros).fetchone()
+            if fila is None:
+                return False
+            registro = de_json(fila[1])
+            if registro.get('version', 0) != version:
+                return False
+            registro.update(cambios, version=version + 1)
+            conexion.execute(f'UPDATE {tabla} SET doc = ? WHERE id = ?', (a_json(registro), fila[0]))
+            return True
+
+    def contar_registros(self, nombre, filtro=None):
+        donde, parametros = _donde(filtro)
+        return self._conexion().execute(f'SELECT COUNT(*) FROM {self._tabla(nombre)}{donde}', parametros).fetchone()[0]
+
+    def reemplazar_registros(self, nombre, registros):
+        tabla = self._tabla(nombre)
+        with self._transaccion() as conexion:
+            conexion.execute(f'DELETE FROM {tabla}')
+            conexion.executemany(f'INSERT INTO {tabla} (doc) VALUES (?)', [(a_json(r),) for r in registros])
+
+    def mover_registros(self, nombre, destino, filtro):
+        origen, destino = self._tabla(nombre), self._tabla(destino)
+        donde, parametros = _donde(filtro)
+        with self._transaccion() as conexion:
+            conexion.execute(f'INSERT INTO {destino} (doc) SELECT doc FROM {origen}{donde} ORDER BY id', parametros)
+            return conexion.execute(f'DELETE FROM {origen}{donde}', parametros).rowcount
+
+    def actualizar_estado_comprobante(self, nombre, comprobante_id, estado, estado_anterior=None):
+        filtro = {'comprobante_id': comprobante_id}
+        if estado_anterior is not None:
+            # Solo se aplica la transición si nadie más la aplicó antes
+            filtro['estado'] = estado_anterior
+        donde, parametros = _donde(filtro)
+        filas = self._conexion().execute(
+            f"UPDATE {self._tabla(nombre)} SET doc = json_set(doc, '$.estado', ?){donde} RETURNING doc",
+            [estado] + parametros).fetchall()
+        return de_json(filas[0][0]) if filas else None
+
+    def buscar_usuario(self, nombre, chat_id):
+        registros = self.cargar_registros(nombre, {'chat_id': chat_id})
+        return registros[0] if registros else None
+
+    def guardar_usuario(self, nombre, usuario):
+        tabla = self._tabla(nombre)
+        with self._transaccion() as conexion:
+            self._reemplazar_usuario(conexion, tabla, usuario)
+
+    def _reemplazar_usuario(self, conexion, tabla, usuario):
+        actualizados = conexion.execute(
+            f"UPDATE {tabla} SET doc = ? WHERE {_campo('chat_id')} = ?",
+            (a_json(usuario), usuario['chat_id'])).rowcount
+        if not actualizados:
+            conexion.execute(f'INSERT INTO {tabla} (doc) VALUES (?)', (a_json(usuario),))
+
+    # Códigos en espera
+
+    def liberar_codigos(self, nombre_usados, nombre_pool, ahora):
+        usados, pool = self._tabla(nombre_usados), self._tabla(nombre_pool)
+        with self._transaccion() as conexion:
+            # Las fechas son objetos {"$date": iso} y se comparan como texto (usa el índice liberar_en)
+            vencidos = conexion.execute(
+                f"SELECT id, {_campo('codigo')} FROM {usados} WHERE {_campo('liberar_en')} <= json(?)",
+                (a_json(ahora),)).fetchall()
+            if not vencidos:
+                return []
+            # Un código que ya está en el pool no se repite (índice único de codigo)
+            codigos = [codigo for _, codigo in vencidos if conexion.execute(
+                f'INSERT OR IGNORE INTO {pool} (doc) VALUES (?)',
+                (a_json({'codigo': codigo, 'aleatorio': random.random()}),)).rowcount]
+            conexion.executemany(f'DELETE FROM {usados} WHERE id = ?', [(id_,) for id_, _ in vencidos])
+            return codigos
+
+    def reclamar_aleatorio(self, nombre, punto):
+        tabla = self._tabla(nombre)
+        # El primero a partir de un punto al azar; si no hay, se da la vuelta al inicio
+        for condicion, parametros in ((f" WHERE {_campo('aleatorio')} >= ?", (punto,)), ('', ())):
+            fila = self._conexion().execute(
+                f"DELETE FROM {tabla} WHERE id = (SELECT id FROM {tabla}{condicion} "
+                f"ORDER BY {_campo('aleatorio')} LIMIT 1) RETURNING {_campo('codigo')}", parametros).fetchone()
+            if fila:
+                return fila[0]
+        return None
+
+    def programar_codigos(self, nombre_pool, nombre_programados, nombre_usados, huecos, punto):
+        pool, programados, usados = (self._tabla(n) for n in (nombre_pool, nombre_programados, nombre_usados))
+        with self._transaccion() as conexion:
+            huecos = [h for h in huecos if not conexion.execute(
+                f"SELECT 1 FROM {programados} WHERE {_campo('pagina')} = ? AND {_campo('dia')} = ?",
+                (h['pagina'], h['dia'])).fetchone()]
+            # Una racha de códigos a partir de un punto al azar, dando la vuelta si no alcanza
+            elegidos = conexion.execute(
+                f"SELECT id, {_campo('codigo')} FROM {pool} WHERE {_campo('aleatorio')} >= ? "
+                f"ORDER BY {_campo('aleatorio')} LIMIT ?", (punto, len(huecos))).fetchall()
+            if len(elegidos) < len(huecos):
+                elegidos += conexion.execute(
+                    f"SELECT id, {_campo('codigo')} FROM {pool} WHERE {_campo('aleatorio')} < ? "
+                    f"ORDER BY {_campo('aleatorio')} LIMIT ?", (punto, len(huecos) - len(elegidos))).fetchall()
+
+            nuevos = [{'pagina': h['pagina'], 'dia': h['dia'], 'codigo': codigo}
+                      for h, (_, codigo) in zip(huecos, elegidos)]
+            conexion.executemany(f'DELETE FROM {pool} WHERE id = ?', [(id_,) for id_, _ in elegidos])
+            conexion.executemany(f'INSERT INTO {programados} (doc) VALUES (?)', [(a_json(n),) for n in nuevos])
+            conexion.executemany(f'INSERT INTO {usados} (doc) VALUES (?)', [
+                (a_json({'codigo': n['codigo'], 'fecha': h['dia'], 'liberar_en': h['liberar_en']}),)
+                for h, n in zip(huecos, nuevos)])
+            return nuevos
+
+    # Contadores
+
+    def reservar_secuencia(self, nombre, contador, cantidad):
+        tabla = self._tabla(nombre)
+        with self._transaccion() as conexion:
+            return self._incrementar(conexion, tabla, contador, cantidad)
+
+    def _incrementar(self, conexion, tabla, contador, cantidad):
+        fila = conexion.execute(
+            f"UPDATE {tabla} SET doc = json_set(doc, '$.valor', {_campo('valor')} + ?) "
+            f"WHERE {_campo('_id')} = ? RETURNING {_campo('valor')}", (cantidad, contador)).fetchone()
+        if fila:
+            return fila[0]
+        conexion.execute(f'INSERT INTO {tabla} (doc) VALUES (?)', (a_json({'_id': contador, 'valor': cantidad}),))
+        return cantidad
+
+    def incrementar_contadores(self, nombre, cambios):
+        tabla = self._tabla(nombre)
+        with self._transaccion() as conexion:
+            for contador, cantidad in cambios.items():
+                self._incrementar(conexion, tabla, contador, cantidad)
+
+    def leer_contadores(self, nombre, contadores):
+        marcas = ', '.join('?' for _ in contadores)
+        filas = self._conexion().execute(
+            f"SELECT {_campo('_id')}, {_campo('valor')} FROM {self._tabla(nombre)} WHERE {_campo('_id')} IN ({marcas})",
+            list(contadores)).fetchall()
+        return dict(filas)
+
+    def fijar_contador(self, nombre, contador, valor):
+        tabla = self._tabla(nombre)
+        with self._transaccion() as conexion:
+            conexion.execute(f"DELETE FROM {tabla} WHERE {_campo('_id')} = ?", (contador,))
+            conexion.execute(f'INSERT INTO {tabla} (doc) VALUES (?)', (a_json({'_id': contador, 'valor': valor}),))
+
+    # Escrituras diferidas
+
+    def aplicar_escrituras(self, preparar, secuencia):
+        """Aplica un lote de la cola de escritura y marca su secuencia en una sola transacción.
+
+        `preparar(aplicada)` devuelve los grupos de operaciones posteriores a la
+        secuencia ya aplicada, que se lee dentro de la transacción: si el lote ya
+        estaba guardado (reintento o reaplicación del diario) no se repite nada.
+        """
+        # Las tablas se crean antes de abrir la transacción (con todo el lote)
+        for _, nombre, _ in preparar(0):
+            self._tabla(nombre)
+        marca = self._tabla('cola_escritura')
+        with self._transaccion() as conexion:
+            fila = conexion.execute(f'SELECT doc FROM {marca} LIMIT 1').fetchone()
+            aplicada = de_json(fila[0])['secuencia'] if fila else 0
+            if aplicada >= secuencia:
+                return
+            for tipo, nombre, datos in preparar(aplicada):
+                tabla = self._tabla(nombre)
+                if tipo == 'agregar_registro':
+                    conexion.executemany(f'INSERT INTO {tabla} (doc) VALUES (?)', [(a_json(r),) for r in datos])
+                elif tipo == 'guardar_usuario':
+                    for usuario in datos:
+                        self._reemplazar_usuario(conexion, tabla, usuario)
+                elif tipo == 'actualizar_estado_comprobante':
+                    conexion.executemany(
+                        f"UPDATE {tabla} SET doc = json_set(doc, '$.estado', ?) WHERE {_campo('comprobante_id')} = ?",
+                        [(d['estado'], d['comprobante_id']) for d in datos])
+                elif tipo == 'incrementar_contador':
+                    for dato in datos:
+                        self._incrementar(conexion, tabla, dato['contador'], dato['cantidad'])
+                else:
+                    raise ValueError(f"Operación no soportada: {tipo}")
+            conexion.execute(f'DELETE FROM {marca}')
+            conexion.execute(f'INSERT INTO {marca} (doc) VALUES (?)', (a_json({'secuencia': secuencia}),))
+
+    def secuencia_aplicada(self):
+        """Última secuencia de la cola de escritura que ya está guardada"""
+        documento = self.cargar_documento('cola_escritura')
+        return documento['secuencia'] if documento else 0
+
+    # Historial
+
+    def cargar_particiones(self, nombre):
+        filas = self._conexion().execute(
+            f"SELECT doc FROM {self._tabla(nombre)} ORDER BY {_campo('fecha')}, id").fetchall()
+        return [de_json(fila[0]) for fila in filas]
+
+    def archivar_registros(self, nombre, destino, tipo, fecha):
+        """Mueve los registros a particiones del historial recorriéndolos con un cursor, en una transacción"""
+        origen, destino = self._tabla(nombre), self._tabla(destino)
+        creado = a_json(datetime.now())
+        movidos = 0
+        with self._transaccion() as conexion:
+            cursor = conexion.execute(f'SELECT doc FROM {origen} ORDER BY id')
+            while True:
+                filas = cursor.fetchmany(LOTE_HISTORIAL)
+                if not filas:
+                    break
+                # Los documentos ya están en JSON: se arma el arreglo sin decodificarlos
+                conexion.execute(
+                    f"INSERT INTO {destino} (doc) VALUES (json_object("
+                    f"'tipo', ?, 'fecha', ?, 'creado', json(?), 'registros', json(?)))",
+                    (tipo, fecha, creado, '[' + ','.join(fila[0] for fila in filas) + ']'))
+                movidos += len(filas)
+            conexion.execute(f'DELETE FROM {origen}')
+        return movidos
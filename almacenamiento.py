@@ -0,0 +1,585 @@
+import os
+import copy
+import json
+import random
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+from dotenv import load_dotenv
+
+# Campos que antes se guardaban como un único arreglo dentro de un documento
+# y que ahora se guardan como un documento por registro
+CAMPOS_POR_REGISTRO = ('usuarios', 'compras', 'participantes', 'ganadores', 'comprobantes')
+
+# Colección -> campo del arreglo antiguo
+COLECCIONES_POR_REGISTRO = {
+    'registro': 'usuarios',
+    'compras': 'compras',
+    'gratis': 'participantes',
+    'ganadores': 'ganadores',
+    'comprobantes_pendientes': 'comprobantes',
+}
+
+# Colección de historial -> tipo de rifa. Cada sorteo archivado se guarda en
+# documentos propios {'tipo', 'fecha', 'creado', 'registros'} de hasta
+# LOTE_HISTORIAL registros, en lugar de un único diccionario {'historial': {...}}
+COLECCIONES_HISTORIAL = {
+    'historial_rifa': 'pagada',
+    'historial_gratis': 'gratis',
+}
+LOTE_HISTORIAL = 1000
+
+# Índices de cada colección: (campos, único)
+INDICES = {
+    'registro': [(('chat_id',), True)],
+    'compras': [(('chat_id',), False), (('comprobante_id',), False)],
+    'gratis': [(('chat_id', 'fecha_registro'), False)],
+    'ganadores': [(('fecha',), False)],
+    'comprobantes_pendientes': [(('comprobante_id',), False), (('estado',), False)],
+    'comprobantes_archivados': [(('comprobante_id',), False), (('chat_id',), False)],
+    # Códigos usados esperando volver a estar disponibles
+    'codigos_usados': [(('liberar_en',), False), (('codigo',), False)],
+    # Códigos disponibles, uno por documento con una clave aleatoria para sortearlos
+    'codigos_pool': [(('aleatorio',), False), (('codigo',), True)],
+    # Páginas de distribución: una por documento con su código activo
+    'paginas': [(('numero',), True), (('activa',), False), (('codigo',), False)],
+    # Código asignado de antemano a cada página y día
+    'codigos_programados': [(('pagina', 'dia'), True), (('dia',), False)],
+    # Una participación por chat y día en la rifa gratis
+    'participaciones': [(('chat_id', 'dia'), True), (('dia',), False)],
+    # En MongoDB el contador es el _id; en SQLite hace falta el índice
+    'contadores': [(('_id',), True)],
+    'historial_rifa': [(('tipo', 'fecha'), False), (('fecha',), False)],
+    'historial_gratis': [(('tipo', 'fecha'), False), (('fecha',), False)],
+}
+
+# Referencia a una colección del almacenamiento activo
+Coleccion = namedtuple('Coleccion', ['name', 'almacen'])
+
+def crear_almacen(conectar_mongodb=None):
+    """Crea el almacenamiento elegido con la variable de entorno ALMACENAMIENTO"""
+    tipo = os.getenv('ALMACENAMIENTO', 'mongodb').lower()
+    if tipo == 'sqlite':
+        from almacen_sqlite import AlmacenSQLite
+        return AlmacenSQLite(os.getenv('SQLITE_RUTA', 'rifas.db'))
+    if tipo == 'mongodb':
+        from almacen_mongo import AlmacenMongo
+        return AlmacenMongo(conectar_mongodb())
+    raise ValueError(f"Almacenamiento no soportado: {tipo}")
+
+# Segundos que una lectura se sirve desde la caché, por colección.
+# Las escrituras hechas por el bot invalidan la caché al instante; el TTL
+# solo acota cuánto tarda en verse un cambio hecho por otro proceso.
+TTL_CACHE = {
+    'registro': 300,
+    'compras': 60,
+    'gratis': 60,
+    'ganadores': 300,
+    'comprobantes_pendientes': 30,
+    'links': 300,
+    'paginas': 30,  # main.py la lee en cada visita; los cambios del bot se ven en 30 s
+    'historial_rifa': 600,
+    'historial_gratis': 600,
+    'codigos': 0,  # main.py la modifica en cada visita, no se cachea
+}
+TTL_CACHE_POR_DEFECTO = 60
+
+_cache = {}
+_generaciones_cache = {}
+_cache_lock = threading.Lock()
+estadisticas_cache = {'aciertos': 0, 'fallos': 0, 'invalidaciones': 0}
+
+def leer_con_cache(coleccion, campo, cargar):
+    """Devuelve una copia del valor cacheado o lo carga con cargar() si expiró"""
+    ttl = TTL_CACHE.get(coleccion.name, TTL_CACHE_POR_DEFECTO)
+    if ttl <= 0:
+        return cargar()
+
+    clave = (coleccion.name, campo)
+    with _cache_lock:
+        entrada = _cache.get(clave)
+        if entrada is not None and entrada[0] > time.monotonic():
+            estadisticas_cache['aciertos'] += 1
+            return copy.deepcopy(entrada[1])
+        estadisticas_cache['fallos'] += 1
+        generacion = _generaciones_cache.get(coleccion.name, 0)
+
+    valor = cargar()
+
+    with _cache_lock:
+        # Si hubo una escritura mientras se cargaba, el valor ya no es fiable
+        if _generaciones_cache.get(coleccion.name, 0) == generacion:
+            _cache[clave] = (time.monotonic() + ttl, valor)
+    return copy.deepcopy(valor)
+
+def invalidar_cache(coleccion):
+    """Descarta todas las lecturas cacheadas de una colección"""
+    with _cache_lock:
+        _generaciones_cache[coleccion.name] = _generaciones_cache.get(coleccion.name, 0) + 1
+        for clave in [c for c in _cache if c[0] == coleccion.name]:
+            del _cache[clave]
+        estadisticas_cache['invalidaciones'] += 1
+
+def copiar_registro(registro):
+    """Devuelve una copia del registro sin el _id del almacenamiento"""
+    copia = dict(registro)
+    copia.pop('_id', None)
+    return copia
+
+def _codificar(valor):
+    """Convierte a JSON los tipos que json no soporta"""
+    if isinstance(valor, datetime):
+        return {'$date': valor.isoformat()}
+    raise TypeError(f"Tipo no soportado: {type(valor).__name__}")
+
+def _decodificar(objeto):
+    """Restaura los tipos codificados por _codificar"""
+    if len(objeto) == 1 and '$date' in objeto:
+        return datetime.fromisoformat(objeto['$date'])
+    return objeto
+
+def a_json(documento):
+    """Serializa un documento a JSON (SQLite y diario de escrituras)"""
+    return json.dumps(documento, default=_codificar, ensure_ascii=False)
+
+def de_json(texto):
+    """Deserializa un documento guardado con a_json"""
+    return json.loads(texto, object_hook=_decodificar)
+
+def particiones_historial(tipo, fecha, registros):
+    """Divide los registros de un sorteo en documentos de historial"""
+    creado = datetime.now()
+    registros = [copiar_registro(r) for r in registros]
+    return [
+        {'tipo': tipo, 'fecha': fecha, 'creado': creado, 'registros': registros[i:i + LOTE_HISTORIAL]}
+        for i in range(0, len(registros), LOTE_HISTORIAL)
+    ]
+
+# Documentos únicos (códigos, links)
+
+def cargar_documento(coleccion):
+    """Carga el documento único de una colección o None si no existe"""
+    return coleccion.almacen.cargar_documento(coleccion.name)
+
+def insertar_documento(coleccion, documento):
+    """Inserta el documento único de una colección"""
+    try:
+        coleccion.almacen.insertar_documento(coleccion.name, copiar_registro(documento))
+        invalidar_cache(coleccion)
+        return True
+    except Exception as e:
+        print(f"Error al insertar documento en {coleccion.name}: {e}")
+        return False
+
+# Reintentos de una modificación con control de versión antes de rendirse
+INTENTOS_VERSION = 8
+
+def actualizar_documento_si_version(coleccion, cambios, version):
+    """Actualiza el documento único solo si sigue en la versión leída (True, False o None si hubo error)"""
+    try:
+        cambios = copiar_registro(cambios)
+        cambios.pop('version', None)
+        aplicado = coleccion.almacen.actualizar_documento_si_version(coleccion.name, cambios, version)
+        if aplicado:
+            invalidar_cache(coleccion)
+        return aplicado
+    except Exception as e:
+        print(f"Error al actualizar documento en {coleccion.name}: {e}")
+        return None
+
+def actualizar_registro_si_version(coleccion, filtro, cambios, version):
+    """Actualiza el registro que cumple el filtro solo si sigue en la versión leída (True, False o None si hubo error)"""
+    try:
+        cambios = copiar_registro(cambios)
+        cambios.pop('version', None)
+        aplicado = coleccion.almacen.actualizar_registro_si_version(coleccion.name, filtro, cambios, version)
+        if aplicado:
+            invalidar_cache(coleccion)
+        return aplicado
+    except Exception as e:
+        print(f"Error al actualizar registro en {coleccion.name}: {e}")
+        return None
+
+def _modificar_con_version(nombre, cargar, guardar, modificar, intentos):
+    """Bucle de compare-and-swap común a documentos únicos y registros"""
+    for intento in range(intentos):
+        documento = cargar()
+        if documento is None:
+            return None
+        version = documento.get('version', 0)
+        original = copy.deepcopy(documento)
+        resultado = modificar(documento)
+        if documento == original:
+            return resultado
+
+        aplicado = guardar(documento, version)
+        if aplicado:
+            return resultado
+        if aplicado is None:
+            return None
+        # Conflicto: esperar un poco (con jitter) antes de reintentar
+        time.sleep(random.uniform(0, 0.005 * 2 ** intento))
+
+    print(f"No se pudo modificar {nombre}: demasiados conflictos de versión")
+    return None
+
+def modificar_documento(coleccion, modificar, intentos=INTENTOS_VERSION):
+    """Lee el documento único, le aplica modificar(documento) y lo guarda con compare-and-swap.
+
+    Si otro proceso lo cambió entre la lectura y la escritura se vuelve a leer
+    y a aplicar modificar. Devuelve lo que devuelva modificar, o None si no se
+    pudo guardar. Si modificar no cambia el documento no se escribe nada.
+    """
+    return _modificar_con_version(
+        coleccion.name,
+        lambda: cargar_documento(coleccion),
+        lambda documento, version: actualizar_documento_si_version(coleccion, documento, version),
+        modificar, intentos)
+
+def modificar_registro(coleccion, filtro, modificar, intentos=INTENTOS_VERSION):
+    """Como modificar_documento, pero sobre el registro que cumple el filtro (None si no existe)"""
+    def cargar():
+        registros = cargar_registros(coleccion, filtro)
+        return registros[0] if registros else None
+
+    return _modificar_con_version(
+        coleccion.name,
+        cargar,
+        lambda registro, version: actualizar_registro_si_version(coleccion, filtro, registro, version),
+        modificar, intentos)
+
+def guardar_documento(coleccion, documento):
+    """Reemplaza el contenido de una colección por un único documento"""
+    try:
+        coleccion.almacen.guardar_documento(coleccion.name, copiar_registro(documento))
+        return True
+    except Exception as e:
+        print(f"Error al guardar datos en {coleccion.name}: {e}")
+        return False
+    finally:
+        invalidar_cache(coleccion)
+
+# Colecciones con un documento por registro
+
+def cargar_registros(coleccion, filtro=None):
+    """Carga los registros de una colección en orden de inserción"""
+    return coleccion.almacen.cargar_registros(coleccion.name, filtro)
+
+def cargar_valores(coleccion, campo):
+    """Valores de un campo en todos los registros (sin cargar los documentos enteros)"""
+    return coleccion.almacen.cargar_valores(coleccion.name, campo)
+
+def agregar_registro(coleccion, registro):
+    """Inserta un único registro sin reescribir el resto de la colección"""
+    try:
+        coleccion.almacen.agregar_registro(coleccion.name, copiar_registro(registro))
+        invalidar_cache(coleccion)
+        return True
+    except Exception as e:
+        print(f"Error al agregar registro en {coleccion.name}: {e}")
+        return False
+
+def contar_registros(coleccion, filtro=None):
+    """Cuenta los registros que cumplen un filtro en el servidor"""
+    return coleccion.almacen.contar_registros(coleccion.name, filtro)
+
+def mover_registros(coleccion, destino, filtro):
+    """Mueve a otra colección los registros que cumplen el filtro y devuelve cuántos (None si hubo error)"""
+    try:
+        movidos = coleccion.almacen.mover_registros(coleccion.name, destino.name, filtro)
+        invalidar_cache(coleccion)
+        invalidar_cache(destino)
+        return movidos
+    except Exception as e:
+        print(f"Error al mover registros de {coleccion.name} a {destino.name}: {e}")
+        return None
+
+def actualizar_estado_comprobante(coleccion, comprobante_id, estado, estado_anterior=None):
+    """Cambia el estado de un comprobante de forma atómica y lo devuelve actualizado"""
+    try:
+        comprobante = coleccion.almacen.actualizar_estado_comprobante(
+            coleccion.name, comprobante_id, estado, estado_anterior)
+        invalidar_cache(coleccion)
+        return comprobante
+    except Exception as e:
+        print(f"Error al actualizar comprobante {comprobante_id}: {e}")
+        return None
+
+def reemplazar_registros(coleccion, registros):
+    """Reemplaza todos los registros de una colección en una sola transacción"""
+    try:
+        coleccion.almacen.reemplazar_registros(coleccion.name, [copiar_registro(r) for r in registros])
+        invalidar_cache(coleccion)
+        return True
+    except Exception as e:
+        print(f"Error al reemplazar registros en {coleccion.name}: {e}")
+        return False
+
+# Participaciones de hoy en la rifa gratis (chat_id) en memoria; se recargan al cambiar de día
+_participaciones = {'dia': None, 'chat_ids': set()}
+_participaciones_lock = threading.Lock()
+
+def _inicio_del_dia():
+    return datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+def _participantes_del_dia(coleccion, dia):
+    """Devuelve los chat_id que participaron ese día (se llama con _participaciones_lock tomado)"""
+    if _participaciones['dia'] != dia:
+        registros = coleccion.almacen.cargar_registros(coleccion.name, {'dia': dia})
+        _participaciones['dia'] = dia
+        _participaciones['chat_ids'] = {r['chat_id'] for r in registros}
+    return _participaciones['chat_ids']
+
+def ya_participo(coleccion, chat_id):
+    """Indica en tiempo constante si el chat ya participó hoy"""
+    try:
+        with _participaciones_lock:
+            return chat_id in _participantes_del_dia(coleccion, _inicio_del_dia())
+    except Exception as e:
+        print(f"Error al consultar participaciones: {e}")
+        return False
+
+def registrar_participacion(coleccion, chat_id):
+    """Registra la participación de hoy (True), False si ya existía o None si hubo error.
+
+    El índice único (chat_id, dia) rechaza también los envíos simultáneos.
+    """
+    dia = _inicio_del_dia()
+    try:
+        with _participaciones_lock:
+            if chat_id in _participantes_del_dia(coleccion, dia):
+                return False
+        insertado = coleccion.almacen.insertar_si_no_existe(
+            coleccion.name, {'chat_id': chat_id, 'dia': dia, 'fecha': datetime.now()})
+    except Exception as e:
+        print(f"Error al registrar participación de {chat_id}: {e}")
+        return None
+
+    with _participaciones_lock:
+        if _participaciones['dia'] == dia:
+            _participaciones['chat_ids'].add(chat_id)
+    return insertado
+
+def reiniciar_participaciones(coleccion):
+    """Borra las participaciones al sortear la rifa gratis: se puede volver a participar el mismo día"""
+    try:
+        with _participaciones_lock:
+            coleccion.almacen.vaciar(coleccion.name)
+            # Se recargan de la base de datos en la próxima consulta
+            _participaciones['dia'] = None
+            _participaciones['chat_ids'] = set()
+        return True
+    except Exception as e:
+        print(f"Error al reiniciar participaciones: {e}")
+        return False
+
+def reservar_secuencia(coleccion, contador, cantidad=1):
+    """Reserva `cantidad` valores de un contador con un solo incremento atómico y devuelve el último"""
+    try:
+        return coleccion.almacen.reservar_secuencia(coleccion.name, contador, cantidad)
+    except Exception as e:
+        print(f"Error al reservar {cantidad} valores de {contador}: {e}")
+        return None
+
+def descontar_contador(coleccion, contador, cantidad=1):
+    """Resta `cantidad` a un contador con un decremento atómico y devuelve lo que queda (None si hubo error)"""
+    try:
+        return coleccion.almacen.reservar_secuencia(coleccion.name, contador, -cantidad)
+    except Exception as e:
+        print(f"Error al descontar {cantidad} de {contador}: {e}")
+        return None
+
+def incrementar_contadores(coleccion, cambios):
+    """Aplica varios incrementos atómicos ($inc) {contador: cantidad}; True si se guardaron"""
+    cambios = {contador: cantidad for contador, cantidad in cambios.items() if cantidad}
+    if not cambios:
+        return True
+    try:
+        coleccion.almacen.incrementar_contadores(coleccion.name, cambios)
+        return True
+    except Exception as e:
+        print(f"Error al incrementar contadores {', '.join(cambios)}: {e}")
+        return False
+
+def leer_contadores(coleccion, contadores):
+    """Valores de los contadores pedidos (0 si aún no existen), leídos por _id"""
+    valores = coleccion.almacen.leer_contadores(coleccion.name, contadores)
+    return {contador: valores.get(contador, 0) for contador in contadores}
+
+def liberar_codigos(usados, pool, ahora=None):
+    """Devuelve al pool los códigos cuyo liberar_en ya pasó; solo lee los que vencen"""
+    try:
+        liberados = usados.almacen.liberar_codigos(usados.name, pool.name, ahora or datetime.now())
+        if liberados:
+            invalidar_cache(usados)
+            invalidar_cache(pool)
+        return liberados
+    except Exception as e:
+        print(f"Error al liberar códigos: {e}")
+        return None
+
+def agregar_al_pool(pool, codigos):
+    """Agrega códigos al pool, cada uno con una clave aleatoria para sortearlos.
+
+    Devuelve cuántos se agregaron: el índice único de `codigo` descarta los que
+    ya estaban, aunque los agregue otro proceso a la vez (None si hubo error).
+    """
+    if not codigos:
+        return 0
+    try:
+        agregados = pool.almacen.agregar_sin_repetir(
+            pool.name, [{'codigo': c, 'aleatorio': random.random()} for c in codigos])
+        invalidar_cache(pool)
+        return agregados
+    except Exception as e:
+        print(f"Error al agregar códigos al pool: {e}")
+        return None
+
+def reclamar_codigo(pool):
+    """Saca un código al azar del pool en una sola operación atómica (None si está vacío)"""
+    try:
+        return pool.almacen.reclamar_aleatorio(pool.name, random.random())
+    except Exception as e:
+        print(f"Error al reclamar código del pool: {e}")
+        return None
+
+def programar_codigos(pool, programados, usados, huecos):
+    """Asigna códigos del pool a los huecos {pagina, dia, liberar_en} que aún no tienen uno.
+
+    Todo en una transacción: los códigos salen del pool, se guardan en la
+    programación y quedan en espera en `usados`. Devuelve los programados
+    nuevos o None si hubo error.
+    """
+    if not huecos:
+        return []
+    try:
+        nuevos = pool.almacen.programar_codigos(
+            pool.name, programados.name, usados.name, [copiar_registro(h) for h in huecos], random.random())
+        if nuevos:
+            invalidar_cache(pool)
+            invalidar_cache(programados)
+            invalidar_cache(usados)
+        return nuevos
+    except Exception as e:
+        print(f"Error al programar códigos: {e}")
+        return None
+
+def fijar_contador(coleccion, contador, valor):
+    """Fija el valor de un contador (p. ej. al recalcularlo)"""
+    try:
+        coleccion.almacen.fijar_contador(coleccion.name, contador, valor)
+        return True
+    except Exception as e:
+        print(f"Error al fijar el contador {contador}: {e}")
+        return False
+
+# Índice en memoria chat_id -> usuario registrado
+_usuarios_por_chat = {}
+# chat_id que se sabe que no están registrados -> vence; acotado en tamaño y tiempo
+# porque cualquiera que escriba al bot agrega uno
+_no_registrados = OrderedDict()
+MAX_NO_REGISTRADOS = 10000
+TTL_NO_REGISTRADO = 300
+_usuarios_lock = threading.Lock()
+
+def buscar_usuario(coleccion, chat_id):
+    """Devuelve el usuario registrado con ese chat_id o None, en tiempo constante"""
+    with _usuarios_lock:
+        if chat_id in _usuarios_por_chat:
+            return dict(_usuarios_por_chat[chat_id])
+        vence = _no_registrados.get(chat_id)
+        if vence is not None:
+            if time.monotonic() < vence:
+                return None
+            del _no_registrados[chat_id]
+
+    try:
+        usuario = coleccion.almacen.buscar_usuario(coleccion.name, chat_id)
+    except Exception as e:
+        print(f"Error al buscar usuario {chat_id}: {e}")
+        return None
+
+    with _usuarios_lock:
+        if usuario is not None:
+            _usuarios_por_chat.setdefault(chat_id, usuario)
+        elif chat_id not in _usuarios_por_chat:
+            _no_registrados[chat_id] = time.monotonic() + TTL_NO_REGISTRADO
+            _no_registrados.move_to_end(chat_id)
+            while len(_no_registrados) > MAX_NO_REGISTRADOS:
+                _no_registrados.popitem(last=False)
+    return dict(usuario) if usuario is not None else None
+
+def guardar_usuario(coleccion, usuario):
+    """Inserta o reemplaza un usuario por su chat_id en una sola operación"""
+    try:
+        usuario = copiar_registro(usuario)
+        coleccion.almacen.guardar_usuario(coleccion.name, usuario)
+        recordar_usuario(usuario)
+        invalidar_cache(coleccion)
+        return True
+    except Exception as e:
+        print(f"Error al guardar usuario {usuario.get('chat_id')}: {e}")
+        return False
+
+def recordar_usuario(usuario):
+    """Actualiza el índice en memoria con un usuario guardado o por guardar"""
+    with _usuarios_lock:
+        _usuarios_por_chat[usuario['chat_id']] = usuario
+        _no_registrados.pop(usuario['chat_id'], None)
+
+def eliminar_usuarios(coleccion):
+    """Borra todos los usuarios registrados y vacía el índice en memoria"""
+    try:
+        coleccion.almacen.vaciar(coleccion.name)
+        return True
+    except Exception as e:
+        print(f"Error al borrar usuarios: {e}")
+        return False
+    finally:
+        with _usuarios_lock:
+            _usuarios_por_chat.clear()
+            _no_registrados.clear()
+        invalidar_cache(coleccion)
+
+# Historial particionado por sorteo
+
+def cargar_historial(coleccion):
+    """Reconstruye el historial como {fecha: [registros]} en orden cronológico"""
+    historial = {}
+    for particion in coleccion.almacen.cargar_particiones(coleccion.name):
+        historial.setdefault(particion['fecha'], []).extend(particion.get('registros', []))
+    return historial
+
+def archivar_registros(coleccion, historial, fecha):
+    """Mueve todos los registros de una colección al historial como un sorteo, dentro de la base de datos.
+
+    Devuelve cuántos registros se movieron o None si hubo error.
+    """
+    try:
+        movidos = coleccion.almacen.archivar_registros(
+            coleccion.name, historial.name, COLECCIONES_HISTORIAL[historial.name], fecha)
+        invalidar_cache(coleccion)
+        invalidar_cache(historial)
+        return movidos
+    except Exception as e:
+        print(f"Error al archivar {coleccion.name} en {historial.name}: {e}")
+        return None
+
+def vaciar_historial(coleccion):
+    """Borra todas las particiones de un historial"""
+    try:
+        coleccion.almacen.vaciar(coleccion.name)
+        invalidar_cache(coleccion)
+        return True
+    except Exception as e:
+        print(f"Error al borrar historial de {coleccion.name}: {e}")
+        return False
+
+if __name__ == '__main__':
+    # Migración única desde los documentos con arreglos
+    load_dotenv()
+    from conexion import conectar_mongodb
+
+    crear_almacen(conectar_mongodb).migrar()
+    print("Migración completada")
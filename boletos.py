@@ -0,0 +1,24 @@
+# Números de boleto: enteros consecutivos de un contador en la base de datos,
+# mostrados en base32 de Crockford (sin I, L, O ni U para evitar confusiones)
+ALFABETO = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+LONGITUD_MINIMA = 4
+
+def codificar_boleto(numero):
+    """Convierte un número de boleto en su forma corta (p. ej. 1234 -> '016J')"""
+    if numero < 0:
+        raise ValueError("El número de boleto no puede ser negativo")
+    texto = ''
+    while numero:
+        numero, resto = divmod(numero, 32)
+        texto = ALFABETO[resto] + texto
+    return texto.rjust(LONGITUD_MINIMA, '0')
+
+def formatear_boleto(boleto):
+    """Texto a mostrar de un boleto (los antiguos uuid se muestran tal cual)"""
+    if isinstance(boleto, int):
+        return codificar_boleto(boleto)
+    return str(boleto)
+
+def formatear_boletos(boletos):
+    """Lista de boletos separada por comas"""
+    return ', '.join(formatear_boleto(b) for b in boletos)
@@ -0,0 +1,158 @@
+# Carga de códigos en lote en codigos_pool: generación aleatoria sin repetidos
+# e importación desde archivos CSV o NDJSON, escribiendo de LOTE_CODIGOS en LOTE_CODIGOS
+import csv
+import json
+import random
+import sys
+from almacenamiento import agregar_al_pool, cargar_valores, incrementar_contadores, leer_contadores
+
+# Los códigos generados son numéricos, de LONGITUD_CODIGO dígitos con ceros a la izquierda
+LONGITUD_CODIGO = 6
+
+# Códigos por escritura en el almacenamiento
+LOTE_CODIGOS = 10000
+
+# Colecciones donde puede estar un código (ninguno nuevo puede coincidir con ellos)
+COLECCIONES_CODIGOS = ('codigos_pool', 'codigos_usados', 'codigos_programados', 'paginas')
+
+# Contadores de códigos en la colección contadores (se actualizan con $inc al moverse),
+# guardados como codigos_<nombre>
+CONTADORES_CODIGOS = ('disponibles', 'usados', 'generados', 'asignados')
+
+# Los códigos se muestran al público: se sortean con el generador del sistema
+_azar = random.SystemRandom()
+
+def codigos_existentes(almacen):
+    """Conjunto con todos los códigos que ya están en el pool, en espera o en una página"""
+    existentes = set()
+    for nombre in COLECCIONES_CODIGOS:
+        existentes.update(str(c) for c in cargar_valores(almacen.coleccion(nombre), 'codigo'))
+    return existentes
+
+def leer_estadisticas_codigos(contadores):
+    """Estadísticas de códigos leídas solo de los contadores, sin recorrer los pools"""
+    valores = leer_contadores(contadores, [f'codigos_{nombre}' for nombre in CONTADORES_CODIGOS])
+    return {nombre: valores[f'codigos_{nombre}'] for nombre in CONTADORES_CODIGOS}
+
+def generar_codigos(cantidad, existentes, longitud=LONGITUD_CODIGO):
+    """Genera `cantidad` códigos distintos entre sí y de los de `existentes`"""
+    if not 1 <= longitud <= 18:
+        raise ValueError("La longitud de los códigos debe estar entre 1 y 18 dígitos")
+    espacio = 10 ** longitud
+    ocupados = {int(c) for c in existentes if len(c) == longitud and c.isdigit()}
+    libres = espacio - len(ocupados)
+    if cantidad > libres:
+        raise ValueError(f"Solo quedan {libres} códigos libres de {longitud} dígitos")
+
+    if cantidad * 2 > libres:
+        # Espacio casi lleno: se sortea entre los libres en vez de reintentar choques
+        elegidos = _azar.sample([n for n in range(espacio) if n not in ocupados], cantidad)
+    else:
+        elegidos = set()
+        while len(elegidos) < cantidad:
+            numero = _azar.randrange(espacio)
+            if numero not in ocupados:
+                elegidos.add(numero)
+
+    return [f'{n:0{longitud}d}' for n in elegidos]
+
+def leer_codigos(lineas, formato):
+    """Recorre un archivo de códigos sin cargarlo entero: 'csv' (primera columna) o 'ndjson'"""
+    if formato == 'csv':
+        for fila in csv.reader(lineas):
+            if fila and fila[0].strip().lower() != 'codigo':
+                yield fila[0].strip()
+    elif formato == 'ndjson':
+        for linea in lineas:
+            if linea.strip():
+                try:
+                    valor = json.loads(linea)
+                except ValueError:
+                    # Línea que no es JSON: se cuenta como código no válido y se sigue leyendo
+                    yield ''
+                    continue
+                yield str(valor.get('codigo', '') if isinstance(valor, dict) else valor).strip()
+    else:
+        raise ValueError(f"Formato de códigos no soportado: {formato}")
+
+def formato_de(nombre_archivo):
+    """Formato de un archivo de códigos según su extensión"""
+    return 'ndjson' if nombre_archivo.lower().endswith(('.ndjson', '.jsonl', '.json')) else 'csv'
+
+def cargar_codigos(almacen, codigos, existentes):
+    """Agrega al pool los códigos nuevos en lotes y devuelve el resumen de la carga.
+
+    Se descartan los vacíos y los que ya están en `existentes` (también los
+    repetidos dentro de la misma carga). Si otro proceso carga los mismos
+    códigos a la vez, el índice único del pool rechaza los que lleguen
+    segundos y también cuentan como repetidos. Cada lote guardado suma a los
+    contadores codigos_disponibles y codigos_generados lo que se agregó.
+    """
+    pool = almacen.coleccion('codigos_pool')
+    contadores = almacen.coleccion('contadores')
+    resumen = {'agregados': 0, 'repetidos': 0, 'invalidos': 0, 'completo': True}
+
+    def guardar(lote):
+        agregados = agregar_al_pool(pool, lote)
+        if agregados is None:
+            return False
+        incrementar_contadores(contadores, {'codigos_disponibles': agregados, 'codigos_generados': agregados})
+        resumen['agregados'] += agregados
+        resumen['repetidos'] += len(lote) - agregados
+        return True
+
+    lote = []
+    for codigo in codigos:
+        if not codigo or any(c.isspace() for c in codigo):
+            resumen['invalidos'] += 1
+        elif codigo in existentes:
+            resumen['repetidos'] += 1
+        else:
+            existentes.add(codigo)
+            lote.append(codigo)
+            if len(lote) >= LOTE_CODIGOS:
+                if not guardar(lote):
+                    resumen['completo'] = False
+                    return resumen
+                lote = []
+    if lote and not guardar(lote):
+        resumen['completo'] = False
+    return resumen
+
+def generar_en_pool(almacen, cantidad, longitud=LONGITUD_CODIGO):
+    """Genera `cantidad` códigos nuevos y los agrega al pool"""
+    existentes = codigos_existentes(almacen)
+    return cargar_codigos(almacen, generar_codigos(cantidad, existentes, longitud), existentes)
+
+def importar_en_pool(almacen, lineas, formato):
+    """Importa al pool los códigos de un archivo (CSV o NDJSON) leyéndolo por partes"""
+    return cargar_codigos(almacen, leer_codigos(lineas, formato), codigos_existentes(almacen))
+
+if __name__ == '__main__':
+    # Uso: python codigos.py generar CANTIDAD [LONGITUD]
+    #      python codigos.py importar ARCHIVO.csv|ARCHIVO.ndjson
+    from dotenv import load_dotenv
+    from almacenamiento import crear_almacen
+    from conexion import conectar_mongodb
+
+    load_dotenv()
+    if len(sys.argv) < 3 or sys.argv[1] not in ('generar', 'importar'):
+        print("Uso: python codigos.py generar CANTIDAD [LONGITUD] | importar ARCHIVO")
+        sys.exit(1)
+
+    almacen = crear_almacen(conectar_mongodb)
+    try:
+        if sys.argv[1] == 'generar':
+            longitud = int(sys.argv[3]) if len(sys.argv) > 3 else LONGITUD_CODIGO
+            resumen = generar_en_pool(almacen, int(sys.argv[2]), longitud)
+        else:
+            with open(sys.argv[2], encoding='utf-8', newline='') as archivo:
+                resumen = importar_en_pool(almacen, archivo, formato_de(sys.argv[2]))
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    print(f"Agregados {resumen['agregados']} códigos al pool "
+          f"({resumen['repetidos']} repetidos, {resumen['invalidos']} no válidos)")
+    if not resumen['completo']:
+        print("La carga se detuvo por un error al guardar; los códigos ya agregados se conservan")
+        sys.exit(1)
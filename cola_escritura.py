@@ -0,0 +1,206 @@
+import os
+import atexit
+try:
+    import fcntl
+except ImportError:
+    # Windows: sin bloqueo del diario entre procesos
+    fcntl = None
+import threading
+import time
+from almacenamiento import (
+    a_json,
+    de_json,
+    copiar_registro,
+    invalidar_cache,
+    recordar_usuario,
+)
+
+# Operaciones que se pueden diferir y el campo que identifica a su destino
+# (dentro de un lote solo se conserva la última escritura de cada destino)
+OPERACIONES = {
+    'agregar_registro': None,
+    'guardar_usuario': 'chat_id',
+    'actualizar_estado_comprobante': 'comprobante_id',
+    'incrementar_contador': None,
+}
+
+def agrupar_operaciones(lote):
+    """Agrupa operaciones consecutivas del mismo tipo y colección para escribirlas juntas"""
+    grupos = []
+    for operacion in lote:
+        tipo, nombre = operacion['tipo'], operacion['coleccion']
+        if grupos and grupos[-1][0] == tipo and grupos[-1][1] == nombre:
+            grupos[-1][2].append(operacion['datos'])
+        else:
+            grupos.append((tipo, nombre, [operacion['datos']]))
+
+    for indice, (tipo, nombre, datos) in enumerate(grupos):
+        clave = OPERACIONES[tipo]
+        if tipo == 'incrementar_contador':
+            # Los incrementos de un mismo contador se suman en uno solo
+            totales = {}
+            for dato in datos:
+                totales[dato['contador']] = totales.get(dato['contador'], 0) + dato['cantidad']
+            grupos[indice] = (tipo, nombre, [{'contador': c, 'cantidad': n} for c, n in totales.items()])
+        elif clave:
+            ultimos = {}
+            for dato in datos:
+                ultimos.pop(dato[clave], None)
+                ultimos[dato[clave]] = dato
+            grupos[indice] = (tipo, nombre, list(ultimos.values()))
+    return grupos
+
+class ColaEscritura:
+    """Escrituras diferidas: los handlers encolan y un hilo las guarda en lotes.
+
+    Cada operación se anota primero en un diario en disco (una línea JSON con
+    fsync) y recibe una secuencia creciente. El hilo de escritura aplica los
+    lotes en una transacción que también guarda la última secuencia aplicada,
+    así al reiniciar se reaplica solo lo que no llegó a la base de datos. Un
+    lote cuya secuencia ya está marcada no se vuelve a aplicar.
+    """
+
+    def __init__(self, almacen, ruta_diario, intervalo=0.5, lote_maximo=500, espera_error=5):
+        self.almacen = almacen
+        self.ruta_diario = ruta_diario
+        self.intervalo = intervalo
+        self.lote_maximo = lote_maximo
+        self.espera_error = espera_error
+        self._pendientes = []
+        self._secuencia = 0
+        self._diario = None
+        self._bloqueo = None
+        self._lock = threading.Lock()
+        self._escritura_lock = threading.Lock()
+        self._hay_pendientes = threading.Event()
+
+    def iniciar(self):
+        """Recupera las operaciones del diario que faltan por aplicar y arranca el hilo"""
+        self._bloquear_diario()
+        aplicada = self.almacen.secuencia_aplicada()
+        self._secuencia = aplicada
+        if os.path.exists(self.ruta_diario):
+            with open(self.ruta_diario, encoding='utf-8') as archivo:
+                for linea in archivo:
+                    try:
+                        operacion = de_json(linea)
+                    except ValueError:
+                        # Línea incompleta de una caída a mitad de escritura
+                        continue
+                    self._secuencia = max(self._secuencia, operacion['secuencia'])
+                    if operacion['secuencia'] > aplicada:
+                        self._pendientes.append(operacion)
+
+        if self._pendientes:
+            print(f"Recuperadas {len(self._pendientes)} escrituras pendientes del diario")
+            self._hay_pendientes.set()
+        self._reescribir_diario()
+
+        threading.Thread(target=self._trabajar, daemon=True).start()
+        atexit.register(self.sincronizar)
+
+    def encolar(self, tipo, coleccion, datos):
+        """Anota una operación en el diario y la deja para el hilo de escritura"""
+        if tipo not in OPERACIONES:
+            raise ValueError(f"Operación no soportada: {tipo}")
+        with self._lock:
+            self._secuencia += 1
+            operacion = {'secuencia': self._secuencia, 'tipo': tipo, 'coleccion': coleccion.name, 'datos': datos}
+            self._diario.write(a_json(operacion) + '\n')
+            self._diario.flush()
+            os.fsync(self._diario.fileno())
+            self._pendientes.append(operacion)
+        self._hay_pendientes.set()
+
+    def agregar_registro(self, coleccion, registro):
+        """Versión diferida de almacenamiento.agregar_registro"""
+        self.encolar('agregar_registro', coleccion, copiar_registro(registro))
+        return True
+
+    def guardar_usuario(self, coleccion, usuario):
+        """Versión diferida de almacenamiento.guardar_usuario"""
+        usuario = copiar_registro(usuario)
+        self.encolar('guardar_usuario', coleccion, usuario)
+        # El índice en memoria se actualiza ya para que las búsquedas lo vean
+        recordar_usuario(usuario)
+        return True
+
+    def actualizar_estado_comprobante(self, coleccion, comprobante_id, estado):
+        """Versión diferida de almacenamiento.actualizar_estado_comprobante (sin condición)"""
+        self.encolar('actualizar_estado_comprobante', coleccion, {'comprobante_id': comprobante_id, 'estado': estado})
+        return True
+
+    def incrementar_contador(self, coleccion, contador, cantidad=1):
+        """Incremento diferido de un contador (se guarda junto con el resto del lote)"""
+        self.encolar('incrementar_contador', coleccion, {'contador': contador, 'cantidad': cantidad})
+        return True
+
+    def pendientes(self, nombre=None):
+        """Cantidad de operaciones sin guardar (de una colección o de todas)"""
+        with self._lock:
+            return sum(1 for op in self._pendientes if nombre is None or op['coleccion'] == nombre)
+
+    def sincronizar(self, nombre=None):
+        """Guarda ya las operaciones pendientes si alguna afecta a la colección indicada"""
+        while self.pendientes(nombre):
+            self._escribir()
+
+    def _trabajar(self):
+        """Hilo de escritura: espera operaciones y las guarda en lotes"""
+        while True:
+            self._hay_pendientes.wait()
+            # Dejar que se acumulen las operaciones que llegan juntas
+            time.sleep(self.intervalo)
+            try:
+                self._escribir()
+            except Exception as e:
+                print(f"Error al guardar escrituras diferidas, se reintentará: {e}")
+                time.sleep(self.espera_error)
+
+    def _escribir(self):
+        """Aplica el siguiente lote de operaciones pendientes"""
+        with self._escritura_lock:
+            with self._lock:
+                lote = self._pendientes[:self.lote_maximo]
+                if not lote:
+                    self._hay_pendientes.clear()
+                    return
+
+            # Solo se agrupan las operaciones que la base de datos todavía no tiene
+            self.almacen.aplicar_escrituras(
+                lambda aplicada: agrupar_operaciones([op for op in lote if op['secuencia'] > aplicada]),
+                lote[-1]['secuencia'])
+
+            with self._lock:
+                del self._pendientes[:len(lote)]
+                self._reescribir_diario()
+                if not self._pendientes:
+                    self._hay_pendientes.clear()
+
+            for nombre in {op['coleccion'] for op in lote}:
+                invalidar_cache(self.almacen.coleccion(nombre))
+
+    def _bloquear_diario(self):
+        """Impide que dos procesos usen el mismo diario (cada uno reaplicaría lo del otro)"""
+        if fcntl is None:
+            return
+        self._bloqueo = open(self.ruta_diario + '.lock', 'w')
+        try:
+            fcntl.flock(self._bloqueo.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._bloqueo.close()
+            self._bloqueo = None
+            raise RuntimeError(f"El diario {self.ruta_diario} ya está en uso por otro proceso")
+
+    def _reescribir_diario(self):
+        """Deja en el diario solo las operaciones pendientes (se llama con _lock tomado)"""
+        if self._diario is not None:
+            self._diario.close()
+        temporal = self.ruta_diario + '.tmp'
+        with open(temporal, 'w', encoding='utf-8') as archivo:
+            for operacion in self._pendientes:
+                archivo.write(a_json(operacion) + '\n')
+            archivo.flush()
+            os.fsync(archivo.fileno())
+        os.replace(temporal, self.ruta_diario)
+        self._diario = open(self.ruta_diario, 'a', encoding='utf-8')
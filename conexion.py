@@ -0,0 +1,140 @@
+import os
+import threading
+import time
+import certifi
+from pymongo import MongoClient, monitoring
+from pymongo.server_api import ServerApi
+
+class MonitorPool(monitoring.ConnectionPoolListener):
+    """Recoge métricas del pool de conexiones: conexiones en uso y espera de checkout"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inicio_checkout = threading.local()
+        self.metricas = {
+            'abiertas': 0,
+            'en_uso': 0,
+            'max_en_uso': 0,
+            'esperando': 0,
+            'checkouts': 0,
+            'checkouts_fallidos': 0,
+            'espera_total_ms': 0.0,
+            'espera_max_ms': 0.0,
+        }
+
+    def estadisticas(self):
+        """Copia de las métricas con la espera media de checkout"""
+        with self._lock:
+            metricas = dict(self.metricas)
+        metricas['espera_media_ms'] = (
+            metricas['espera_total_ms'] / metricas['checkouts'] if metricas['checkouts'] else 0.0)
+        return metricas
+
+    # El checkout empieza y termina en el hilo que pide la conexión
+    def connection_check_out_started(self, event):
+        self._inicio_checkout.valor = time.monotonic()
+        with self._lock:
+            self.metricas['esperando'] += 1
+
+    def connection_checked_out(self, event):
+        espera = (time.monotonic() - getattr(self._inicio_checkout, 'valor', time.monotonic())) * 1000
+        with self._lock:
+            self.metricas['esperando'] -= 1
+            self.metricas['checkouts'] += 1
+            self.metricas['en_uso'] += 1
+            self.metricas['max_en_uso'] = max(self.metricas['max_en_uso'], self.metricas['en_uso'])
+            self.metricas['espera_total_ms'] += espera
+            self.metricas['espera_max_ms'] = max(self.metricas['espera_max_ms'], espera)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.metricas['esperando'] -= 1
+            self.metricas['checkouts_fallidos'] += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.metricas['en_uso'] -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.metricas['abiertas'] += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.metricas['abiertas'] -= 1
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+monitor_pool = MonitorPool()
+
+_cliente = None
+_cliente_lock = threading.Lock()
+
+def _entero(nombre, por_defecto):
+    return int(os.getenv(nombre, por_defecto))
+
+def crear_cliente():
+    """Crea el MongoClient con las opciones del pool tomadas del entorno"""
+    opciones = {
+        'server_api': ServerApi('1'),
+        'maxPoolSize': _entero('MONGODB_MAX_POOL', 50),
+        'minPoolSize': _entero('MONGODB_MIN_POOL', 5),
+        'waitQueueTimeoutMS': _entero('MONGODB_ESPERA_POOL_MS', 5000),
+        'connectTimeoutMS': _entero('MONGODB_TIMEOUT_MS', 10000),
+        'serverSelectionTimeoutMS': _entero('MONGODB_TIMEOUT_MS', 10000),
+        'socketTimeoutMS': _entero('MONGODB_SOCKET_TIMEOUT_MS', 30000),
+        'retryWrites': True,
+        'retryReads': True,
+        'event_listeners': [monitor_pool],
+    }
+    uri = os.getenv('MONGODB_URI')
+    if uri and (uri.startswith('mongodb+srv://') or 'tls=true' in uri.lower()):
+        opciones['tlsCAFile'] = certifi.where()
+        # Solo para entornos con proxies que rompen la cadena de certificados
+        if os.getenv('MONGODB_TLS_INSEGURO', '').lower() in ('1', 'true', 'si'):
+            opciones['tlsAllowInvalidCertificates'] = True
+    return MongoClient(uri, **opciones)
+
+def calentar_pool(cliente):
+    """Abre de antemano las conexiones mínimas del pool para no pagarlas en la primera petición"""
+    cliente.admin.command('ping')
+    minimo = cliente.options.pool_options.min_pool_size
+    hilos = [threading.Thread(target=cliente.admin.command, args=('ping',)) for _ in range(minimo)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+def obtener_cliente():
+    """Devuelve el MongoClient compartido del proceso, creándolo y calentándolo la primera vez"""
+    global _cliente
+    with _cliente_lock:
+        if _cliente is None:
+            cliente = crear_cliente()
+            try:
+                calentar_pool(cliente)
+            except Exception as e:
+                print(f"No se pudo calentar el pool de MongoDB: {e}")
+            _cliente = cliente
+        return _cliente
+
+def conectar_mongodb():
+    """Devuelve la base de datos configurada usando el cliente compartido"""
+    return obtener_cliente()[os.getenv('MONGODB_DB_NAME')]
+
+def estadisticas_pool():
+    """Métricas del pool de conexiones de este proceso"""
+    return monitor_pool.estadisticas()
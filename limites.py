@@ -0,0 +1,103 @@
+# Límites de peticiones con cubos de fichas (token bucket): cada clave tiene
+# `capacidad` fichas que se recargan a `por_segundo` y cada petición gasta una
+import os
+import threading
+import time
+from collections import OrderedDict
+
+class CubosMemoria:
+    """Cubos en memoria del proceso (cada worker de gunicorn lleva su cuenta).
+
+    Como mucho guarda max_cubos claves: al pasarse se descarta la usada hace más tiempo.
+    """
+
+    def __init__(self, max_cubos=100000):
+        self.max_cubos = max_cubos
+        self._cubos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consumir(self, clave, capacidad, por_segundo):
+        """Gasta una ficha: devuelve 0 si hay, o los segundos hasta la próxima"""
+        ahora = time.monotonic()
+        with self._lock:
+            fichas, ultimo = self._cubos.get(clave, (capacidad, ahora))
+            fichas = min(capacidad, fichas + (ahora - ultimo) * por_segundo)
+            if fichas >= 1:
+                self._cubos[clave] = (fichas - 1, ahora)
+                espera = 0
+            else:
+                self._cubos[clave] = (fichas, ahora)
+                espera = (1 - fichas) / por_segundo
+            self._cubos.move_to_end(clave)
+            if len(self._cubos) > self.max_cubos:
+                self._cubos.popitem(last=False)
+            return espera
+
+# Recarga y consumo atómicos en el servidor: KEYS[1] = clave,
+# ARGV = capacidad, fichas por segundo, ahora (s); devuelve la espera en ms
+_SCRIPT_CUBO = """
+local capacidad = tonumber(ARGV[1])
+local por_segundo = tonumber(ARGV[2])
+local ahora = tonumber(ARGV[3])
+local cubo = redis.call('HMGET', KEYS[1], 'fichas', 'ultimo')
+local fichas = tonumber(cubo[1]) or capacidad
+local ultimo = tonumber(cubo[2]) or ahora
+fichas = math.min(capacidad, fichas + math.max(0, ahora - ultimo) * por_segundo)
+local espera = 0
+if fichas >= 1 then
+    fichas = fichas - 1
+else
+    espera = math.ceil((1 - fichas) / por_segundo * 1000)
+end
+redis.call('HSET', KEYS[1], 'fichas', tostring(fichas), 'ultimo', tostring(ahora))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacidad / por_segundo * 1000) + 1000)
+return espera
+"""
+
+class CubosRedis:
+    """Cubos compartidos por todos los workers en Redis (o un servidor compatible)"""
+
+    def __init__(self, url, prefijo='limite:'):
+        # Dependencia opcional: solo hace falta con LIMITES=redis
+        import redis
+        self.cliente = redis.Redis.from_url(url, socket_timeout=0.2, socket_connect_timeout=0.2)
+        self.prefijo = prefijo
+        self._script = self.cliente.register_script(_SCRIPT_CUBO)
+
+    def consumir(self, clave, capacidad, por_segundo):
+        """Gasta una ficha: devuelve 0 si hay, o los segundos hasta la próxima"""
+        return self._script(keys=[self.prefijo + clave], args=[capacidad, por_segundo, time.time()]) / 1000
+
+def crear_cubos():
+    """Crea el almacén de cubos elegido con la variable de entorno LIMITES"""
+    tipo = os.getenv('LIMITES', 'memoria').lower()
+    if tipo == 'redis':
+        try:
+            return CubosRedis(os.getenv('LIMITES_REDIS_URL', 'redis://localhost:6379/0'))
+        except Exception as e:
+            print(f"No se pudo usar Redis para los límites, se usan en memoria: {e}")
+            return CubosMemoria()
+    if tipo == 'memoria':
+        return CubosMemoria()
+    raise ValueError(f"Almacén de límites no soportado: {tipo}")
+
+class Limitador:
+    """Aplica a una petición varios cubos (por IP, por página...) y dice cuánto esperar"""
+
+    def __init__(self, cubos, reglas):
+        # reglas: {nombre: [(ámbito, capacidad, fichas por segundo), ...]}
+        self.cubos = cubos
+        self.reglas = reglas
+
+    def espera(self, nombre, claves):
+        """Segundos que debe esperar la petición (0 si puede pasar); claves: {ámbito: valor}"""
+        for ambito, capacidad, por_segundo in self.reglas.get(nombre, []):
+            try:
+                espera = self.cubos.consumir(f'{nombre}:{ambito}:{claves[ambito]}', capacidad, por_segundo)
+            except Exception as e:
+                # Si el almacén compartido falla no se bloquea a nadie
+                print(f"Error al consultar el límite {nombre}:{ambito}: {e}")
+                continue
+            if espera:
+                return espera
+        return 0
@@ -1,18 +1,58 @@
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, Response, abort, render_template, request, jsonify, session
 import json
-from datetime import datetime, timedelta
-import random
+import copy
+import hashlib
+import hmac
+from datetime import datetime, timedelta, timezone
 import os
 import threading
 import time
 import subprocess
-from pymongo import MongoClient
-from pymongo.server_api import ServerApi
+import atexit
+import functools
+import gzip
+import io
+import math
 from dotenv import load_dotenv
+from werkzeug.middleware.proxy_fix import ProxyFix
+from conexion import conectar_mongodb, estadisticas_pool
+from almacenamiento import (
+    crear_almacen,
+    cargar_documento,
+    cargar_registros,
+    insertar_documento,
+    actualizar_documento_si_version,
+    modificar_documento,
+    agregar_registro,
+    contar_registros,
+    liberar_codigos,
+    agregar_al_pool,
+    reclamar_codigo,
+    programar_codigos,
+    modificar_registro,
+    incrementar_contadores,
+    fijar_contador,
+)
+from limites import Limitador, crear_cubos
+from codigos import LONGITUD_CODIGO, formato_de, generar_en_pool, importar_en_pool, leer_estadisticas_codigos
+from paginas import (
+    buscar_pagina,
+    cargar_paginas,
+    migrar_paginas,
+    necesita_codigo_nuevo,
+    proxima_rotacion,
+    pagina_de_codigo,
+    recordar_codigo_pagina,
+)
 import psutil
 import logging
 import sys
 
+try:
+    import brotli
+except ImportError:
+    brotli = None  # Opcional: sin él las páginas se sirven solo con gzip
+
 # Cargar variables de entorno
 load_dotenv()
 
@@ -31,11 +71,57 @@ rifa_process = None
 
 # Constantes
 DIAS_ESPERA = 20  # Días que debe esperar un código usado para volver a estar disponible
+INTERVALO_LIBERACION = int(os.getenv('INTERVALO_LIBERACION_CODIGOS', 3600))  # Segundos entre liberaciones
+DIAS_PROGRAMACION = int(os.getenv('DIAS_PROGRAMACION_CODIGOS', 7))  # Días de códigos asignados de antemano
+INTERVALO_PROGRAMACION = int(os.getenv('INTERVALO_PROGRAMACION_CODIGOS', 3600))  # Segundos entre programaciones
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')  # Token para los endpoints de administración
+INTERVALO_USOS = int(os.getenv('INTERVALO_GUARDADO_USOS', 30))  # Segundos entre guardados de los contadores de uso
+HILOS_WORKER = int(os.getenv('HILOS_WORKER', 100))  # Hilos de cada worker (el --threads de gunicorn)
+# Conexiones de /eventos abiertas a la vez por worker: por defecto la mitad de los hilos,
+# para que las demás rutas siempre tengan hilos libres
+MAX_CONEXIONES_SSE = min(int(os.getenv('MAX_CONEXIONES_SSE', HILOS_WORKER // 2)), HILOS_WORKER - 1)
+LATIDO_SSE = 25  # Segundos entre latidos para que proxies no cierren la conexión
+DURACION_SSE = 3600  # Segundos que dura una conexión de /eventos antes de que el navegador se reconecte
+ESPERA_MAX_SSE_SIN_CODIGO = 600  # Máximo de segundos entre intentos de /eventos de obtener código si no hay
 
 # Crear la aplicación Flask
 app = Flask(__name__)
 app.secret_key = os.urandom(24)  # Necesario para usar sesiones
 
+# Detrás de un proxy (p. ej. Render) la IP del cliente llega en X-Forwarded-For; solo se
+# confía en esa cabecera si se indica cuántos proxies hay, si no cualquiera puede falsearla
+PROXIES_CONFIABLES = int(os.getenv('PROXIES_CONFIABLES', 0))
+if PROXIES_CONFIABLES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXIES_CONFIABLES)
+
+def _por_minuto(variable, por_defecto):
+    """Regla de un cubo que admite `n` peticiones por minuto (y ráfagas de hasta `n`)"""
+    n = int(os.getenv(variable, por_defecto))
+    return n, n / 60
+
+# Límites por IP y por página de cada endpoint; LIMITES=redis los comparte entre workers
+limitador = Limitador(crear_cubos(), {
+    'codigo_activo': [('ip', *_por_minuto('LIMITE_CODIGO_IP', 30)),
+                      ('pagina', *_por_minuto('LIMITE_CODIGO_PAGINA', 600))],
+    'verificar': [('ip', *_por_minuto('LIMITE_VERIFICAR_IP', 5)),
+                  ('pagina', *_por_minuto('LIMITE_VERIFICAR_PAGINA', 120))],
+})
+
+def limitar(nombre):
+    """Responde 429 sin tocar la base de datos si la IP o la página superan su límite"""
+    def decorador(vista):
+        @functools.wraps(vista)
+        def envoltura(pagina):
+            espera = limitador.espera(nombre, {'ip': request.remote_addr or '-', 'pagina': pagina})
+            if espera:
+                respuesta = jsonify({'error': 'Demasiadas peticiones, intenta más tarde'})
+                respuesta.headers['Retry-After'] = str(math.ceil(espera))
+                respuesta.headers['Cache-Control'] = 'no-store'
+                return respuesta, 429
+            return vista(pagina)
+        return envoltura
+    return decorador
+
 # Iniciar rifa.py como subproceso
 def iniciar_rifa():
     global rifa_process
@@ -112,52 +198,32 @@ threading.Thread(target=verificar_rifa, daemon=True).start()
 # Iniciar rifa.py inicialmente
 iniciar_rifa()
 
-# Conexión a MongoDB
+# Almacenamiento: MongoDB por defecto o SQLite local con ALMACENAMIENTO=sqlite
 try:
-    uri = os.getenv('MONGODB_URI')
-    client = MongoClient(uri, server_api=ServerApi('1'))
-    db = client[os.getenv('MONGODB_DB_NAME')]
-    codigos_collection = db.codigos
-    print("Conexión a MongoDB establecida correctamente")
+    almacen = crear_almacen(conectar_mongodb)
+    codigos_collection = almacen.coleccion('codigos')
+    codigos_usados_collection = almacen.coleccion('codigos_usados')
+    codigos_pool_collection = almacen.coleccion('codigos_pool')
+    codigos_programados_collection = almacen.coleccion('codigos_programados')
+    paginas_collection = almacen.coleccion('paginas')
+    contadores_collection = almacen.coleccion('contadores')
+    links_collection = almacen.coleccion('links')
+    print("Conexión al almacenamiento establecida correctamente")
 except Exception as e:
-    print(f"Error al conectar con MongoDB: {e}")
-    db = None
+    print(f"Error al conectar con el almacenamiento: {e}")
+    almacen = None
 
 def inicializar_codigos():
-    """Inicializa la estructura de códigos en MongoDB si no existe"""
+    """Inicializa la estructura de códigos en el almacenamiento si no existe"""
     try:
-        datos = codigos_collection.find_one()
+        datos = cargar_documento(codigos_collection)
         if not datos:
             # Si no hay datos, crear estructura inicial
             estructura_inicial = {
                 'codigos_disponibles': [],
                 'codigos_usados': [],
-                'codigos_activos': {
-                    'pagina1': {
-                        'codigo': None,
-                        'fecha_asignacion': None,
-                        'fecha_ultimo_uso': None,
-                        'usos': 0
-                    },
-                    'pagina2': {
-                        'codigo': None,
-                        'fecha_asignacion': None,
-                        'fecha_ultimo_uso': None,
-                        'usos': 0
-                    },
-                    'pagina3': {
-                        'codigo': None,
-                        'fecha_asignacion': None,
-                        'fecha_ultimo_uso': None,
-                        'usos': 0
-                    },
-                    'pagina4': {
-                        'codigo': None,
-                        'fecha_asignacion': None,
-                        'fecha_ultimo_uso': None,
-                        'usos': 0
-                    }
-                },
+                # El código activo de cada página está en la colección paginas
+                'codigos_activos': {},
                 'estadisticas': {
                     'total_codigos_generados': 0,
                     'codigos_disponibles': 0,
@@ -165,19 +231,14 @@ def inicializar_codigos():
                     'ultima_actualizacion': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
                 }
             }
-            codigos_collection.insert_one(estructura_inicial)
+            insertar_documento(codigos_collection, estructura_inicial)
             return estructura_inicial
         else:
             # Verificar y corregir la estructura si es necesario
             estructura_correcta = {
                 'codigos_disponibles': datos.get('codigos_disponibles', []),
                 'codigos_usados': datos.get('codigos_usados', []),
-                'codigos_activos': datos.get('codigos_activos', {
-                    'pagina1': {'codigo': None, 'fecha_asignacion': None, 'fecha_ultimo_uso': None, 'usos': 0},
-                    'pagina2': {'codigo': None, 'fecha_asignacion': None, 'fecha_ultimo_uso': None, 'usos': 0},
-                    'pagina3': {'codigo': None, 'fecha_asignacion': None, 'fecha_ultimo_uso': None, 'usos': 0},
-                    'pagina4': {'codigo': None, 'fecha_asignacion': None, 'fecha_ultimo_uso': None, 'usos': 0}
-                }),
+                'codigos_activos': datos.get('codigos_activos', {}),
                 'estadisticas': datos.get('estadisticas', {
                     'total_codigos_generados': 0,
                     'codigos_disponibles': 0,
@@ -188,15 +249,13 @@ def inicializar_codigos():
             
             # Actualizar estadísticas
             estructura_correcta['estadisticas'].update({
-                'codigos_disponibles': len(estructura_correcta['codigos_disponibles']),
-                'codigos_usados': len(estructura_correcta['codigos_usados']),
                 'ultima_actualizacion': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             })
             
             # Actualizar en la base de datos si hay cambios
             if estructura_correcta != datos:
-                codigos_collection.update_one({}, {'$set': estructura_correcta})
-                print("Estructura de datos actualizada en MongoDB")
+                actualizar_documento_si_version(codigos_collection, estructura_correcta, datos.get('version', 0))
+                print("Estructura de datos actualizada en el almacenamiento")
             
             return estructura_correcta
     except Exception as e:
@@ -204,193 +263,462 @@ def inicializar_codigos():
         return None
 
 def cargar_codigos():
-    """Carga los códigos de MongoDB"""
+    """Carga los códigos del almacenamiento"""
     try:
-        datos = codigos_collection.find_one()
+        datos = cargar_documento(codigos_collection)
         if not datos:
             datos = inicializar_codigos()
         if not datos:
             raise Exception("No se pudieron cargar los datos de la base de datos")
-        
-        # Verificar que hay códigos disponibles
-        if not datos.get('codigos_disponibles'):
-            print("No hay códigos disponibles en la base de datos")
-            return None
             
         return datos
     except Exception as e:
         print(f"Error al cargar códigos: {e}")
         return None
 
-def guardar_codigos(datos):
-    """Guarda los códigos en MongoDB"""
+def actualizar_estadisticas(datos):
+    """Actualiza las estadísticas del documento de códigos"""
+    datos['estadisticas'].update({
+        'ultima_actualizacion': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    })
+
+def modificar_codigos(modificar):
+    """Aplica modificar(datos) al documento de códigos con control de versión.
+
+    Varios workers de gunicorn pueden modificar el documento a la vez: si otro
+    lo cambió entre la lectura y la escritura, se vuelve a leer y a aplicar.
+    """
+    def modificar_y_actualizar(datos):
+        original = copy.deepcopy(datos)
+        resultado = modificar(datos)
+        if datos != original:
+            actualizar_estadisticas(datos)
+        return resultado
+
     try:
-        # Actualizar estadísticas
-        datos['estadisticas'].update({
-            'codigos_disponibles': len(datos['codigos_disponibles']),
-            'codigos_usados': len(datos['codigos_usados']),
-            'ultima_actualizacion': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        })
-        
-        codigos_collection.update_one({}, {'$set': datos})
-        return True
+        return modificar_documento(codigos_collection, modificar_y_actualizar)
     except Exception as e:
         print(f"Error al guardar códigos: {e}")
-        return False
+        return None
+
+def fecha_liberacion(fecha):
+    """Momento en que un código usado el día `fecha` (YYYY-MM-DD) vuelve a estar disponible"""
+    # Igual que antes: se libera cuando su fecha queda más de DIAS_ESPERA días atrás
+    return datetime.strptime(fecha, '%Y-%m-%d') + timedelta(days=DIAS_ESPERA + 1)
+
+def contar_codigos(**cambios):
+    """Suma a los contadores de códigos, p. ej. contar_codigos(disponibles=-1, usados=1)"""
+    return incrementar_contadores(
+        contadores_collection, {f'codigos_{nombre}': cantidad for nombre, cantidad in cambios.items()})
+
+def recalcular_estadisticas_codigos():
+    """Recalcula los contadores de códigos desde las colecciones (al arrancar)"""
+    disponibles = contar_registros(codigos_pool_collection)
+    usados = contar_registros(codigos_usados_collection)
+    fijar_contador(contadores_collection, 'codigos_disponibles', disponibles)
+    fijar_contador(contadores_collection, 'codigos_usados', usados)
+    # Las bases anteriores no llevaban la cuenta de generados: como mínimo, los que existen
+    if leer_estadisticas_codigos(contadores_collection)['generados'] < disponibles + usados:
+        fijar_contador(contadores_collection, 'codigos_generados', disponibles + usados)
+
+def poner_en_espera(codigo, fecha):
+    """Guarda un código usado como documento propio con su fecha de liberación"""
+    guardado = agregar_registro(codigos_usados_collection, {
+        'codigo': codigo,
+        'fecha': fecha,
+        'liberar_en': fecha_liberacion(fecha)
+    })
+    if guardado:
+        contar_codigos(usados=1)
+    return guardado
+
+def migrar_codigos():
+    """Pasa los arreglos antiguos del documento de códigos a codigos_pool y codigos_usados"""
+    def tomar_arreglos(datos):
+        disponibles = datos.get('codigos_disponibles') or []
+        usados = datos.get('codigos_usados') or []
+        if disponibles:
+            datos['codigos_disponibles'] = []
+        if usados:
+            datos['codigos_usados'] = []
+        return disponibles, usados
+
+    disponibles, usados = modificar_codigos(tomar_arreglos) or ([], [])
+    agregados = agregar_al_pool(codigos_pool_collection, disponibles)
+    if agregados:
+        contar_codigos(disponibles=agregados)
+        print(f"Migrados {agregados} códigos disponibles a codigos_pool")
+    for usado in usados:
+        poner_en_espera(usado['codigo'], usado['fecha'])
+    if usados:
+        print(f"Migrados {len(usados)} códigos usados a codigos_usados")
 
 def liberar_codigos_antiguos():
-    """Libera los códigos que han estado usados por más de DIAS_ESPERA días"""
-    datos = cargar_codigos()
-    if not datos:
+    """Libera los códigos cuya espera de DIAS_ESPERA días ya terminó"""
+    migrar_codigos()
+    
+    # Solo se leen los códigos que vencen, gracias al índice liberar_en
+    liberados = liberar_codigos(codigos_usados_collection, codigos_pool_collection)
+    if liberados is None:
         return False
+    if liberados:
+        contar_codigos(usados=-len(liberados), disponibles=len(liberados))
+        print(f"Liberados {len(liberados)} códigos")
+    return True
 
-    fecha_limite = (datetime.now() - timedelta(days=DIAS_ESPERA)).strftime('%Y-%m-%d')
-    codigos_liberados = []
-    
-    # Identificar códigos a liberar
-    nuevos_usados = []
-    for usado in datos['codigos_usados']:
-        if usado['fecha'] < fecha_limite:
-            codigos_liberados.append(usado['codigo'])
-        else:
-            nuevos_usados.append(usado)
-    
-    # Actualizar listas
-    datos['codigos_usados'] = nuevos_usados
-    datos['codigos_disponibles'].extend(codigos_liberados)
-    
-    # Guardar cambios
-    return guardar_codigos(datos)
+def liberar_codigos_periodicamente():
+    """Libera los códigos vencidos cada INTERVALO_LIBERACION segundos"""
+    while True:
+        try:
+            liberar_codigos_antiguos()
+        except Exception as e:
+            logger.error(f"Error al liberar códigos: {e}")
+        time.sleep(INTERVALO_LIBERACION)
+
+def dia_codigo(momento):
+    """Día de rotación al que pertenece un momento: cada código vale de la 1 AM a la 1 AM siguiente"""
+    return (momento - timedelta(hours=1)).strftime('%Y-%m-%d')
+
+def programar_codigos_siguientes(dias=DIAS_PROGRAMACION):
+    """Asigna de antemano, en una sola operación, los códigos de los próximos días de todas las páginas"""
+    paginas = cargar_paginas(paginas_collection)
+    hoy = datetime.strptime(dia_codigo(datetime.now()), '%Y-%m-%d')
+    huecos = []
+    for desplazamiento in range(dias):
+        dia = (hoy + timedelta(days=desplazamiento)).strftime('%Y-%m-%d')
+        for pagina in paginas:
+            # Hoy no hace falta si la página ya tiene un código vigente
+            if desplazamiento == 0 and not necesita_codigo_nuevo(pagina, datetime.now()):
+                continue
+            huecos.append({'pagina': f"pagina{pagina['numero']}", 'dia': dia, 'liberar_en': fecha_liberacion(dia)})
+
+    nuevos = programar_codigos(codigos_pool_collection, codigos_programados_collection,
+                               codigos_usados_collection, huecos)
+    if nuevos:
+        contar_codigos(disponibles=-len(nuevos), usados=len(nuevos))
+        print(f"Programados {len(nuevos)} códigos")
+    return nuevos
+
+def programar_codigos_periodicamente():
+    """Mantiene programados los próximos DIAS_PROGRAMACION días cada INTERVALO_PROGRAMACION segundos"""
+    while True:
+        try:
+            programar_codigos_siguientes()
+        except Exception as e:
+            logger.error(f"Error al programar códigos: {e}")
+        time.sleep(INTERVALO_PROGRAMACION)
+
+def codigo_programado(pagina_key, dia):
+    """Código programado para una página y día, o None (consulta por índice)"""
+    registros = cargar_registros(codigos_programados_collection, {'pagina': pagina_key, 'dia': dia})
+    return registros[0]['codigo'] if registros else None
+
+def cargar_programacion(dias=DIAS_PROGRAMACION):
+    """Programación desde hoy: {dia: {pagina: codigo}}"""
+    hoy = datetime.strptime(dia_codigo(datetime.now()), '%Y-%m-%d')
+    programacion = {}
+    for desplazamiento in range(dias):
+        dia = (hoy + timedelta(days=desplazamiento)).strftime('%Y-%m-%d')
+        registros = cargar_registros(codigos_programados_collection, {'dia': dia})
+        programacion[dia] = {r['pagina']: r['codigo'] for r in registros}
+    return programacion
+
+# Usos de los códigos activos acumulados en memoria: (pagina_key, codigo) -> usos y último uso
+usos_pendientes = {}
+usos_lock = threading.Lock()
+
+# Código activo de cada página hasta su próxima rotación: pagina_key -> (codigo, vence)
+codigos_cache = {}
+codigos_cache_lock = threading.Lock()
+
+# Avisa a las conexiones de /eventos cuando cambia el código de alguna página
+cambios_codigos = threading.Condition()
+
+def recordar_codigo_activo(pagina_key, activo):
+    """Guarda en memoria el código activo de una página hasta su próxima rotación"""
+    vence = proxima_rotacion(activo['fecha_asignacion'])
+    with codigos_cache_lock:
+        anterior = codigos_cache.get(pagina_key)
+        codigos_cache[pagina_key] = (activo['codigo'], vence)
+    recordar_codigo_pagina(activo['codigo'], numero_de(pagina_key), vence)
+    if not anterior or anterior[0] != activo['codigo']:
+        with cambios_codigos:
+            cambios_codigos.notify_all()
+
+def codigo_activo_en_cache(pagina_key, ahora):
+    """Devuelve (codigo, vence) de la página si sigue vigente en memoria, o None"""
+    with codigos_cache_lock:
+        entrada = codigos_cache.get(pagina_key)
+        if entrada and ahora < entrada[1]:
+            return entrada
+        codigos_cache.pop(pagina_key, None)
+        return None
+
+def numero_de(pagina_key):
+    """Número de página a partir de su clave 'paginaN'"""
+    return int(pagina_key[len('pagina'):])
+
+def registrar_uso(pagina_key, codigo, ahora):
+    """Cuenta un uso del código activo en memoria, sin escribir en el almacenamiento"""
+    with usos_lock:
+        uso = usos_pendientes.setdefault((pagina_key, codigo), {'usos': 0, 'fecha_ultimo_uso': None})
+        uso['usos'] += 1
+        uso['fecha_ultimo_uso'] = ahora.strftime('%Y-%m-%d %H:%M:%S')
+
+def guardar_usos():
+    """Suma al documento de códigos los usos acumulados en memoria, en una sola escritura"""
+    with usos_lock:
+        if not usos_pendientes:
+            return True
+        pendientes = dict(usos_pendientes)
+        usos_pendientes.clear()
+
+    fallidos = {}
+    for (pagina_key, codigo), uso in pendientes.items():
+        def sumar_usos(pagina):
+            # Los usos de un código que ya se renovó no se suman al nuevo
+            if pagina['codigo'] == codigo:
+                pagina['usos'] = pagina.get('usos', 0) + uso['usos']
+                pagina['fecha_ultimo_uso'] = max(pagina.get('fecha_ultimo_uso') or '', uso['fecha_ultimo_uso'])
+            return True
+
+        # Una escritura por página con usos pendientes
+        if not modificar_registro(paginas_collection, {'numero': numero_de(pagina_key)}, sumar_usos):
+            fallidos[(pagina_key, codigo)] = uso
+
+    if not fallidos:
+        return True
+
+    # No se pudieron guardar: se devuelven a memoria para el siguiente intento
+    with usos_lock:
+        for clave, uso in fallidos.items():
+            actual = usos_pendientes.setdefault(clave, {'usos': 0, 'fecha_ultimo_uso': None})
+            actual['usos'] += uso['usos']
+            actual['fecha_ultimo_uso'] = max(actual['fecha_ultimo_uso'] or '', uso['fecha_ultimo_uso'])
+    return False
+
+def guardar_usos_periodicamente():
+    """Guarda los contadores de uso cada INTERVALO_USOS segundos"""
+    while True:
+        time.sleep(INTERVALO_USOS)
+        try:
+            guardar_usos()
+        except Exception as e:
+            logger.error(f"Error al guardar los usos de los códigos: {e}")
 
 def obtener_nuevo_codigo(pagina):
-    """Obtiene un nuevo código aleatorio para una página específica"""
-    try:
-        datos = cargar_codigos()
-        if not datos:
-            print("No se pudieron cargar los datos")
-            return None
+    """Obtiene el código activo de una página, asignando uno nuevo al azar si hace falta"""
+    pagina_key = f'pagina{pagina}'
 
-        # Liberar códigos antiguos primero
-        liberar_codigos_antiguos()
-        
-        # Recargar datos después de liberar códigos
-        datos = cargar_codigos()
-        if not datos:
-            return None
+    asignado = {}
+    reclamado = {}
+    programado = {}
+    vigente = {}
+
+    def asignar_codigo(activo):
+        asignado.clear()
+        vigente.clear()
         
-        # Verificar si ya hay un código activo para esta página
-        pagina_key = f'pagina{pagina}'
-        if pagina_key not in datos['codigos_activos']:
-            print(f"Error: No se encontró la página {pagina_key}")
+        # Verificar que la página sigue activa
+        if not activo.get('activa'):
+            print(f"Error: La página {pagina} no está activa")
             return None
-            
-        codigo_actual = datos['codigos_activos'][pagina_key]['codigo']
-        fecha_asignacion = datos['codigos_activos'][pagina_key]['fecha_asignacion']
         
-        # Obtener la fecha y hora actual
-        ahora = datetime.now()
-        
-        # Si hay un código activo, verificar si necesita ser cambiado
-        if codigo_actual and fecha_asignacion:
-            fecha_asignacion = datetime.strptime(fecha_asignacion, '%Y-%m-%d %H:%M:%S')
-            # Verificar si es un nuevo día y si ya pasó la 1 AM
-            if (ahora.date() > fecha_asignacion.date() and 
-                ahora.hour >= 1):
-                # Necesitamos un nuevo código
-                codigo_actual = None
-        
-        if codigo_actual:
-            # Actualizar fecha de último uso
-            datos['codigos_activos'][pagina_key]['fecha_ultimo_uso'] = ahora.strftime('%Y-%m-%d %H:%M:%S')
-            datos['codigos_activos'][pagina_key]['usos'] += 1
-            guardar_codigos(datos)
-            return codigo_actual
-
-        # Verificar si hay códigos disponibles
-        if not datos['codigos_disponibles']:
+        # Otro worker pudo asignar un código entre la lectura y la escritura
+        if not necesita_codigo_nuevo(activo, ahora):
+            vigente['activo'] = dict(activo)
+            return activo['codigo']
+
+        # Con la programación hecha, rotar es solo consultar el código del día
+        dia = dia_codigo(ahora)
+        if 'codigo' not in programado:
+            programado['codigo'] = codigo_programado(pagina_key, dia)
+        if programado['codigo']:
+            activo.update({
+                'codigo': programado['codigo'],
+                'fecha_asignacion': f'{dia} 01:00:00',
+                'fecha_ultimo_uso': ahora.strftime('%Y-%m-%d %H:%M:%S'),
+                'usos': 1
+            })
+            vigente['activo'] = dict(activo)
+            # Ya quedó en espera al programarlo
+            asignado['programado'] = True
+            return programado['codigo']
+
+        # Sin programación: sacar un código al azar del pool en una sola operación (se conserva entre reintentos)
+        if 'codigo' not in reclamado:
+            reclamado['codigo'] = reclamar_codigo(codigos_pool_collection)
+            if reclamado['codigo']:
+                contar_codigos(disponibles=-1)
+        nuevo_codigo = reclamado['codigo']
+        if nuevo_codigo is None:
             print("No hay códigos disponibles")
             return None
-
-        # Seleccionar un nuevo código aleatorio
-        nuevo_codigo = random.choice(datos['codigos_disponibles'])
-        
-        # Remover el código de disponibles
-        datos['codigos_disponibles'].remove(nuevo_codigo)
         
-        # Agregar a usados
-        datos['codigos_usados'].append({
-            'codigo': nuevo_codigo,
-            'fecha': ahora.strftime('%Y-%m-%d')
-        })
+        # Se pasa a usados después de guardar el documento
+        asignado['fecha'] = ahora.strftime('%Y-%m-%d')
         
         # Actualizar código activo para esta página
-        datos['codigos_activos'][pagina_key].update({
+        activo.update({
             'codigo': nuevo_codigo,
             'fecha_asignacion': ahora.strftime('%Y-%m-%d %H:%M:%S'),
             'fecha_ultimo_uso': ahora.strftime('%Y-%m-%d %H:%M:%S'),
             'usos': 1
         })
-        
-        # Guardar cambios
-        if not guardar_codigos(datos):
-            print("Error al guardar los cambios")
-            return None
-            
+        vigente['activo'] = dict(activo)
         return nuevo_codigo
+
+    try:
+        ahora = datetime.now()
+
+        # Camino más rápido: el código sigue en memoria y no ha llegado su rotación
+        entrada = codigo_activo_en_cache(pagina_key, ahora)
+        if entrada:
+            registrar_uso(pagina_key, entrada[0], ahora)
+            return entrada[0]
+
+        activo = buscar_pagina(paginas_collection, pagina)
+        if not activo:
+            print(f"Error: No se encontró la página {pagina}")
+            return None
+
+        # Camino rápido: el código asignado sigue vigente, solo se cuenta el uso en memoria
+        if not necesita_codigo_nuevo(activo, ahora):
+            recordar_codigo_activo(pagina_key, activo)
+            registrar_uso(pagina_key, activo['codigo'], ahora)
+            return activo['codigo']
+
+        # Si otro worker asignó un código a la vez, se reintenta sobre sus datos
+        codigo = modificar_registro(paginas_collection, {'numero': pagina}, asignar_codigo)
+        if codigo:
+            recordar_codigo_activo(pagina_key, vigente['activo'])
+        if codigo and asignado:
+            contar_codigos(asignados=1)
+        if codigo and 'fecha' in asignado:
+            poner_en_espera(codigo, asignado['fecha'])
+        else:
+            if reclamado.get('codigo'):
+                # Otro worker renovó la página antes: el código reclamado vuelve al pool
+                if agregar_al_pool(codigos_pool_collection, [reclamado['codigo']]):
+                    contar_codigos(disponibles=1)
+            if codigo and not asignado:
+                registrar_uso(pagina_key, codigo, ahora)
+        return codigo
     except Exception as e:
         print(f"Error al obtener nuevo código: {e}")
         return None
 
 def verificar_codigo(codigo, pagina):
     """Verifica si un código es válido para una página específica"""
-    datos = cargar_codigos()
-    if not datos:
-        return {'valido': False, 'mensaje': 'Error al cargar códigos'}
-    
-    # Verificar si el código coincide con el activo de la página
-    pagina_key = f'pagina{pagina}'
-    if codigo == datos['codigos_activos'][pagina_key]['codigo']:
+    # Búsqueda directa código -> página (memoria y después índice)
+    if pagina_de_codigo(paginas_collection, codigo) == pagina:
         return {'valido': True, 'mensaje': 'Código válido'}
     
     return {'valido': False, 'mensaje': 'Código no válido'}
 
 def verificar_codigos_mongodb():
-    """Verifica los códigos en MongoDB y muestra su estado"""
+    """Verifica los códigos en el almacenamiento y muestra su estado"""
     try:
-        datos = codigos_collection.find_one()
+        datos = cargar_documento(codigos_collection)
         if datos:
-            print("\nEstado actual de los códigos en MongoDB:")
-            print(f"Códigos disponibles: {len(datos.get('codigos_disponibles', []))}")
-            print(f"Códigos usados: {len(datos.get('codigos_usados', []))}")
-            print(f"Total de códigos: {len(datos.get('codigos_disponibles', [])) + len(datos.get('codigos_usados', []))}")
+            print("\nEstado actual de los códigos en el almacenamiento:")
+            estadisticas = leer_estadisticas_codigos(contadores_collection)
+            disponibles = len(datos.get('codigos_disponibles', [])) + estadisticas['disponibles']
+            usados = len(datos.get('codigos_usados', [])) + estadisticas['usados']
+            print(f"Códigos disponibles: {disponibles}")
+            print(f"Códigos usados: {usados}")
+            print(f"Total de códigos: {disponibles + usados}")
             print(f"Última actualización: {datos.get('estadisticas', {}).get('ultima_actualizacion', 'No disponible')}")
             return True
         else:
-            print("No se encontraron datos en MongoDB")
+            print("No se encontraron datos en el almacenamiento")
             return False
     except Exception as e:
-        print(f"Error al verificar códigos en MongoDB: {e}")
+        print(f"Error al verificar códigos en el almacenamiento: {e}")
         return False
 
-@app.route('/')
-def index():
-    return render_template('index.html', numero_pagina=1)
+# Pasar al registro de páginas los códigos activos y links antiguos, y los arreglos
+# antiguos de códigos a sus colecciones antes de recalcular los contadores
+if almacen is not None:
+    # Solo los índices (entre ellos los únicos de los que depende la coordinación entre
+    # workers), sin esperar al bot; la migración de los datos del bot la hace rifa.py
+    try:
+        almacen.crear_indices()
+    except Exception as e:
+        logger.error(f"Error al crear los índices del almacenamiento: {e}")
+    migrar_paginas(paginas_collection, codigos_collection, links_collection)
+    migrar_codigos()
+    recalcular_estadisticas_codigos()
+
+# Liberar los códigos vencidos y programar los siguientes en segundo plano, no en cada petición,
+# y guardar los usos acumulados en memoria cada INTERVALO_USOS segundos
+if almacen is not None:
+    threading.Thread(target=liberar_codigos_periodicamente, daemon=True).start()
+    threading.Thread(target=programar_codigos_periodicamente, daemon=True).start()
+    threading.Thread(target=guardar_usos_periodicamente, daemon=True).start()
+    atexit.register(guardar_usos)
+
+def pagina_valida(pagina):
+    """Indica si la página existe y está activa en el registro (lectura cacheada)"""
+    return buscar_pagina(paginas_collection, pagina) is not None
 
-@app.route('/pagina2')
-def pagina2():
-    return render_template('index.html', numero_pagina=2)
+# Páginas ya renderizadas y comprimidas: numero -> versión de la plantilla, ETag y cuerpos
+RUTA_PLANTILLA = os.path.join(app.root_path, 'templates', 'index.html')
+paginas_renderizadas = {}
+paginas_renderizadas_lock = threading.Lock()
 
-@app.route('/pagina3')
-def pagina3():
-    return render_template('index.html', numero_pagina=3)
+def renderizar_pagina(pagina):
+    """Renderiza y comprime una página una sola vez, hasta que cambie la plantilla"""
+    version = os.stat(RUTA_PLANTILLA).st_mtime_ns
+    with paginas_renderizadas_lock:
+        entrada = paginas_renderizadas.get(pagina)
+        if entrada and entrada['version'] == version:
+            return entrada
 
-@app.route('/pagina4')
-def pagina4():
-    return render_template('index.html', numero_pagina=4)
+    html = render_template('index.html', numero_pagina=pagina).encode('utf-8')
+    entrada = {
+        'version': version,
+        'etag': hashlib.sha256(html).hexdigest()[:32],
+        'cuerpos': {
+            'identity': html,
+            'gzip': gzip.compress(html, compresslevel=9),
+            'br': brotli.compress(html) if brotli else None,
+        },
+    }
+    with paginas_renderizadas_lock:
+        paginas_renderizadas[pagina] = entrada
+    return entrada
+
+def prerenderizar_paginas():
+    """Deja renderizadas todas las páginas activas al arrancar"""
+    with app.app_context():
+        for pagina in cargar_paginas(paginas_collection):
+            renderizar_pagina(pagina['numero'])
+
+@app.route('/', defaults={'pagina': 1})
+@app.route('/pagina<int:pagina>')
+def mostrar_pagina(pagina):
+    if not pagina_valida(pagina):
+        abort(404)
+
+    entrada = renderizar_pagina(pagina)
+    ofrecidas = ['br', 'gzip'] if entrada['cuerpos']['br'] else ['gzip']
+    codificacion = request.accept_encodings.best_match(ofrecidas) or 'identity'
+
+    respuesta = Response(entrada['cuerpos'][codificacion], mimetype='text/html')
+    if codificacion != 'identity':
+        respuesta.headers['Content-Encoding'] = codificacion
+    respuesta.headers['Vary'] = 'Accept-Encoding'
+    # ETag fuerte distinto por codificación: los bytes enviados son distintos
+    respuesta.set_etag(entrada['etag'] if codificacion == 'identity' else f"{entrada['etag']}-{codificacion}")
+    respuesta.cache_control.public = True
+    respuesta.cache_control.max_age = 300
+    return respuesta.make_conditional(request)
 
 @app.route('/verificar/<int:pagina>', methods=['POST'])
+@limitar('verificar')
 def verificar_por_pagina(pagina):
-    if pagina not in [1, 2, 3, 4]:
+    if not pagina_valida(pagina):
         return jsonify({'valido': False, 'mensaje': 'Página no válida'}), 400
         
     codigo = request.form.get('codigo')
@@ -400,19 +728,163 @@ def verificar_por_pagina(pagina):
     return jsonify(verificar_codigo(codigo, pagina))
 
 @app.route('/codigo_activo/<int:pagina>')
+@limitar('codigo_activo')
 def obtener_codigo_activo(pagina):
-    if pagina not in [1, 2, 3, 4]:
+    if not pagina_valida(pagina):
         return jsonify({'error': 'Página no válida'}), 400
         
     codigo = obtener_nuevo_codigo(pagina)
     if codigo is None:
         return jsonify({'error': 'No hay códigos disponibles'}), 404
-    return jsonify({'codigo': codigo})
+
+    respuesta = jsonify({'codigo': codigo})
+    # Navegadores y CDN pueden guardar la respuesta hasta la próxima rotación del código
+    entrada = codigo_activo_en_cache(f'pagina{pagina}', datetime.now())
+    if entrada:
+        vence = entrada[1]
+        respuesta.set_etag(hashlib.sha256(f'{pagina}:{codigo}'.encode()).hexdigest()[:32])
+        respuesta.cache_control.public = True
+        respuesta.cache_control.max_age = max(0, int((vence - datetime.now()).total_seconds()))
+        respuesta.expires = vence.astimezone(timezone.utc)
+    else:
+        respuesta.cache_control.no_cache = True
+    return respuesta.make_conditional(request)
+
+# Conexiones de /eventos abiertas en este worker
+conexiones_sse = threading.BoundedSemaphore(MAX_CONEXIONES_SSE)
+
+# Marca de "todavía no se envió nada" (None ya significa "no hay código")
+_SIN_ENVIAR = object()
+
+def eventos_codigo(pagina):
+    """Envía el código de la página al conectarse y después solo cuando cambia"""
+    pagina_key = f'pagina{pagina}'
+    enviado = _SIN_ENVIAR
+    # Sin códigos en el pool no se reintenta en cada latido: la espera se duplica hasta ESPERA_MAX_SSE_SIN_CODIGO
+    proximo_intento = 0
+    espera_sin_codigo = LATIDO_SSE
+    fin = time.monotonic() + DURACION_SSE
+    yield 'retry: 10000\n\n'
+    while time.monotonic() < fin:
+        ahora = datetime.now()
+        entrada = codigo_activo_en_cache(pagina_key, ahora)
+        if entrada:
+            codigo = entrada[0]
+            espera_sin_codigo = LATIDO_SSE
+        elif time.monotonic() >= proximo_intento:
+            codigo = obtener_nuevo_codigo(pagina)
+            if codigo is None:
+                proximo_intento = time.monotonic() + espera_sin_codigo
+                espera_sin_codigo = min(espera_sin_codigo * 2, ESPERA_MAX_SSE_SIN_CODIGO)
+        else:
+            codigo = None
+        if codigo != enviado:
+            datos = {'codigo': codigo} if codigo else {'error': 'No hay códigos disponibles'}
+            yield f'data: {json.dumps(datos)}\n\n'
+            enviado = codigo
+        else:
+            yield ': latido\n\n'
+
+        # Despertar en el siguiente latido, en la rotación del código o si otro hilo lo cambia
+        espera = LATIDO_SSE
+        entrada = codigo_activo_en_cache(pagina_key, datetime.now())
+        if entrada:
+            espera = min(espera, max(0, (entrada[1] - datetime.now()).total_seconds()) + 1)
+        with cambios_codigos:
+            cambios_codigos.wait(espera)
+
+@app.route('/eventos/<int:pagina>')
+def eventos(pagina):
+    if not pagina_valida(pagina):
+        return jsonify({'error': 'Página no válida'}), 400
+
+    # Con el límite alcanzado se responde enseguida y la página sigue consultando cada minuto
+    if not conexiones_sse.acquire(blocking=False):
+        respuesta = jsonify({'error': 'Demasiadas conexiones'})
+        respuesta.headers['Retry-After'] = '60'
+        return respuesta, 503
+
+    respuesta = Response(eventos_codigo(pagina), mimetype='text/event-stream')
+    respuesta.headers['Cache-Control'] = 'no-cache'
+    respuesta.headers['X-Accel-Buffering'] = 'no'
+    # Se libera al cerrar la respuesta, aunque el generador no llegue a empezar
+    respuesta.call_on_close(conexiones_sse.release)
+    return respuesta
+
+def es_administrador():
+    """Comprueba el token de administración (cabecera Authorization: Bearer o parámetro token)"""
+    if not ADMIN_TOKEN:
+        return False
+    cabecera = request.headers.get('Authorization', '')
+    token = cabecera[len('Bearer '):] if cabecera.startswith('Bearer ') else request.args.get('token', '')
+    return hmac.compare_digest(token, ADMIN_TOKEN)
+
+@app.route('/programacion', methods=['GET', 'POST'])
+def programacion():
+    if not es_administrador():
+        return jsonify({'error': 'No autorizado'}), 403
+
+    dias = min(max(request.args.get('dias', DIAS_PROGRAMACION, type=int), 1), 366)
+    # POST completa la programación en el momento, sin esperar al hilo
+    if request.method == 'POST' and programar_codigos_siguientes(dias) is None:
+        return jsonify({'error': 'No se pudo programar'}), 500
+    return jsonify(cargar_programacion(dias))
+
+# Máximo de códigos que se pueden generar en una petición
+MAX_GENERAR_CODIGOS = 1000000
+
+@app.route('/codigos', methods=['POST'])
+def cargar_codigos_pool():
+    # ?generar=N genera N códigos; un archivo (campo 'archivo' o el cuerpo de la petición
+    # en CSV o NDJSON) se importa leyéndolo por partes
+    if not es_administrador():
+        return jsonify({'error': 'No autorizado'}), 403
+
+    try:
+        cantidad = request.args.get('generar', type=int)
+        if cantidad is not None:
+            if not 0 < cantidad <= MAX_GENERAR_CODIGOS:
+                return jsonify({'error': f'generar debe estar entre 1 y {MAX_GENERAR_CODIGOS}'}), 400
+            longitud = request.args.get('longitud', LONGITUD_CODIGO, type=int)
+            resumen = generar_en_pool(almacen, cantidad, longitud)
+        elif 'archivo' in request.files:
+            archivo = request.files['archivo']
+            lineas = io.TextIOWrapper(archivo.stream, encoding='utf-8', newline='')
+            resumen = importar_en_pool(almacen, lineas, formato_de(archivo.filename or ''))
+        else:
+            formato = 'ndjson' if 'json' in (request.mimetype or '') else 'csv'
+            lineas = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+            resumen = importar_en_pool(almacen, lineas, formato)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify(resumen), 200 if resumen['completo'] else 500
+
+@app.route('/stats')
+def stats():
+    if not es_administrador():
+        return jsonify({'error': 'No autorizado'}), 403
+    # Solo lee los contadores: no recorre codigos_pool ni codigos_usados
+    return jsonify(leer_estadisticas_codigos(contadores_collection))
+
+@app.route('/estado_pool')
+def estado_pool():
+    if not es_administrador():
+        return jsonify({'error': 'No autorizado'}), 403
+    # Métricas del pool de MongoDB de este worker
+    return jsonify(estadisticas_pool())
+
+# Renderizar de antemano las páginas activas
+if almacen is not None:
+    try:
+        prerenderizar_paginas()
+    except Exception as e:
+        logger.error(f"Error al prerenderizar las páginas: {e}")
 
 if __name__ == '__main__':
-    # Verificar el estado de los códigos en MongoDB
+    # Verificar el estado de los códigos en el almacenamiento
     verificar_codigos_mongodb()
-    # Inicializar la estructura de códigos en MongoDB
+    # Inicializar la estructura de códigos en el almacenamiento
     inicializar_codigos()
     # Ejecutar en modo desarrollo
     app.run(debug=True, host='0.0.0.0', port=8000)
\ No newline at end of file
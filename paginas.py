@@ -0,0 +1,177 @@
+# Registro de páginas de distribución: un documento por página en la colección
+# `paginas` con su número, su link público y el código activo que muestra
+import threading
+from datetime import datetime, timedelta
+from almacenamiento import (
+    cargar_documento,
+    cargar_registros,
+    guardar_documento,
+    invalidar_cache,
+    leer_con_cache,
+    modificar_documento,
+    modificar_registro,
+)
+
+# Páginas que se crean si el registro está vacío (las que antes eran fijas)
+PAGINAS_INICIALES = 4
+
+# Segundos que se recuerda en memoria a qué página pertenece un código
+# (como máximo hasta su rotación; acota cuánto tarda en verse una página desactivada)
+TTL_CODIGO_PAGINA = 30
+
+# Índice en memoria código -> (número de página, vence)
+_paginas_por_codigo = {}
+_paginas_por_codigo_lock = threading.Lock()
+
+def pagina_nueva(numero, link=None):
+    """Documento de una página sin código asignado"""
+    return {
+        'numero': numero,
+        'link': link,
+        'activa': True,
+        'codigo': None,
+        'fecha_asignacion': None,
+        'fecha_ultimo_uso': None,
+        'usos': 0,
+        'creada': datetime.now(),
+    }
+
+def proxima_rotacion(fecha_asignacion):
+    """Momento a partir del cual un código asignado en `fecha_asignacion` deja de valer (1 AM del día siguiente)"""
+    fecha = datetime.strptime(fecha_asignacion, '%Y-%m-%d %H:%M:%S')
+    return datetime.combine(fecha.date() + timedelta(days=1), datetime.min.time()) + timedelta(hours=1)
+
+def necesita_codigo_nuevo(pagina, ahora):
+    """Indica si la página no tiene código o si el suyo ya caducó (nuevo día, a partir de la 1 AM)"""
+    if not pagina.get('codigo') or not pagina.get('fecha_asignacion'):
+        return True
+    fecha_asignacion = datetime.strptime(pagina['fecha_asignacion'], '%Y-%m-%d %H:%M:%S')
+    return ahora.date() > fecha_asignacion.date() and ahora.hour >= 1
+
+def recordar_codigo_pagina(codigo, numero, vence):
+    """Anota en el índice en memoria que `codigo` es el de la página `numero` hasta `vence`"""
+    ahora = datetime.now()
+    with _paginas_por_codigo_lock:
+        # Se descartan los vencidos para que el índice no crezca más que el número de páginas
+        for vencido in [c for c, (_, fin) in _paginas_por_codigo.items() if fin <= ahora]:
+            del _paginas_por_codigo[vencido]
+        _paginas_por_codigo[codigo] = (numero, min(vence, ahora + timedelta(seconds=TTL_CODIGO_PAGINA)))
+
+def pagina_de_codigo(coleccion, codigo, ahora=None):
+    """Número de la página activa que muestra ahora `codigo`, o None.
+
+    Primero se busca en memoria y si no está, con una consulta por el
+    índice `codigo` de la colección de páginas.
+    """
+    ahora = ahora or datetime.now()
+    with _paginas_por_codigo_lock:
+        entrada = _paginas_por_codigo.get(codigo)
+        if entrada and ahora < entrada[1]:
+            return entrada[0]
+
+    for pagina in cargar_registros(coleccion, {'codigo': codigo, 'activa': True}):
+        if not necesita_codigo_nuevo(pagina, ahora):
+            recordar_codigo_pagina(codigo, pagina['numero'], proxima_rotacion(pagina['fecha_asignacion']))
+            return pagina['numero']
+    return None
+
+def cargar_paginas(coleccion):
+    """Páginas activas ordenadas por número (pasa por la caché de lectura)"""
+    paginas = leer_con_cache(coleccion, 'activas', lambda: cargar_registros(coleccion, {'activa': True}))
+    return sorted(paginas, key=lambda p: p['numero'])
+
+def buscar_pagina(coleccion, numero, cache=True):
+    """Página activa con ese número (consulta por índice) o None"""
+    def cargar():
+        registros = cargar_registros(coleccion, {'numero': numero})
+        return registros[0] if registros and registros[0].get('activa') else None
+
+    if not cache:
+        return cargar()
+    return leer_con_cache(coleccion, ('numero', numero), cargar)
+
+def insertar_pagina(coleccion, pagina):
+    """Inserta una página si su número no existe (True) o False si ya estaba"""
+    insertada = coleccion.almacen.insertar_si_no_existe(coleccion.name, pagina)
+    if insertada:
+        invalidar_cache(coleccion)
+    return insertada
+
+def crear_pagina(coleccion, link=None):
+    """Crea una página con el siguiente número libre y la devuelve (None si hubo error)"""
+    try:
+        while True:
+            numeros = [p['numero'] for p in cargar_registros(coleccion)]
+            pagina = pagina_nueva(max(numeros, default=0) + 1, link)
+            # Si otro proceso tomó el mismo número se prueba con el siguiente
+            if insertar_pagina(coleccion, pagina):
+                return pagina
+    except Exception as e:
+        print(f"Error al crear página: {e}")
+        return None
+
+def agregar_link_pagina(coleccion, link):
+    """Pone el link en la primera página activa sin link o, si todas tienen, crea una nueva.
+
+    Devuelve la página que lo recibió (None si hubo error).
+    """
+    def asignar(pagina):
+        if pagina.get('link'):
+            return False
+        pagina['link'] = link
+        return True
+
+    try:
+        for pagina in cargar_paginas(coleccion):
+            if not pagina.get('link') and modificar_registro(coleccion, {'numero': pagina['numero']}, asignar):
+                return dict(pagina, link=link)
+    except Exception as e:
+        print(f"Error al asignar link a una página: {e}")
+        return None
+    return crear_pagina(coleccion, link)
+
+def desactivar_pagina(coleccion, numero):
+    """Deja de servir una página; su número no se reutiliza"""
+    def desactivar(pagina):
+        if not pagina.get('activa'):
+            return False
+        pagina['activa'] = False
+        return True
+
+    return bool(modificar_registro(coleccion, {'numero': numero}, desactivar))
+
+def migrar_paginas(coleccion, codigos, links):
+    """Pasa al registro los códigos activos del documento de códigos y la lista de links antigua"""
+    try:
+        datos = cargar_documento(codigos) or {}
+        for clave, activo in (datos.get('codigos_activos') or {}).items():
+            if clave.startswith('pagina') and clave[len('pagina'):].isdigit():
+                pagina = pagina_nueva(int(clave[len('pagina'):]))
+                pagina.update({campo: activo.get(campo) for campo in
+                               ('codigo', 'fecha_asignacion', 'fecha_ultimo_uso', 'usos')})
+                pagina['usos'] = pagina['usos'] or 0
+                insertar_pagina(coleccion, pagina)
+        if datos.get('codigos_activos'):
+            modificar_documento(codigos, lambda d: d.update(codigos_activos={}))
+            print("Códigos activos migrados al registro de páginas")
+
+        if not cargar_registros(coleccion):
+            for numero in range(1, PAGINAS_INICIALES + 1):
+                insertar_pagina(coleccion, pagina_nueva(numero))
+
+        # Los links antiguos se asignan en orden a las páginas 1, 2, 3...
+        antiguos = (cargar_documento(links) or {}).get('links') or []
+        for numero, link in enumerate(antiguos, 1):
+            def asignar_link(pagina, link=link):
+                if not pagina.get('link'):
+                    pagina['link'] = link
+                return True
+            if not modificar_registro(coleccion, {'numero': numero}, asignar_link):
+                insertar_pagina(coleccion, pagina_nueva(numero, link))
+        if antiguos:
+            guardar_documento(links, {'links': []})
+            print(f"Migrados {len(antiguos)} links al registro de páginas")
+        return True
+    except Exception as e:
+        print(f"Error al migrar páginas: {e}")
+        return False
@@ -9,10 +9,37 @@ import platform
 import subprocess
 import threading
 import time
-import certifi
-from pymongo.mongo_client import MongoClient
-from pymongo.server_api import ServerApi
 from dotenv import load_dotenv
+from conexion import conectar_mongodb, estadisticas_pool
+from cola_escritura import ColaEscritura
+from boletos import formatear_boleto, formatear_boletos
+from codigos import leer_estadisticas_codigos
+from paginas import agregar_link_pagina, buscar_pagina, cargar_paginas, desactivar_pagina, migrar_paginas, pagina_de_codigo
+from almacenamiento import (
+    CAMPOS_POR_REGISTRO,
+    estadisticas_cache,
+    leer_con_cache,
+    crear_almacen,
+    cargar_documento,
+    insertar_documento,
+    guardar_documento,
+    cargar_registros,
+    reemplazar_registros,
+    contar_registros,
+    reservar_secuencia,
+    descontar_contador,
+    fijar_contador,
+    mover_registros,
+    ya_participo,
+    registrar_participacion,
+    reiniciar_participaciones,
+    actualizar_estado_comprobante,
+    buscar_usuario,
+    eliminar_usuarios,
+    cargar_historial,
+    archivar_registros,
+    vaciar_historial,
+)
 
 # Cargar variables de entorno
 load_dotenv()
@@ -27,32 +54,30 @@ CHAT_SOPORTE = int(os.getenv('CHAT_SOPORTE'))
 CHAT_HISTORIAL = int(os.getenv('CHAT_HISTORIAL'))
 TIEMPO_INACTIVIDAD = int(os.getenv('TIEMPO_INACTIVIDAD'))
 
-# Conexión a MongoDB
-uri = os.getenv('MONGODB_URI')
-client = MongoClient(
-    uri,
-    server_api=ServerApi('1'),
-    tls=True,
-    tlsAllowInvalidCertificates=True,
-    connectTimeoutMS=30000,
-    socketTimeoutMS=30000,
-    serverSelectionTimeoutMS=30000,
-    retryWrites=True,
-    retryReads=True,
-    tlsCAFile=certifi.where()
+# Almacenamiento: MongoDB por defecto o SQLite local con ALMACENAMIENTO=sqlite
+almacen = crear_almacen(conectar_mongodb)
+
+# Colecciones
+registro_collection = almacen.coleccion('registro')
+compras_collection = almacen.coleccion('compras')
+ganadores_collection = almacen.coleccion('ganadores')
+gratis_collection = almacen.coleccion('gratis')
+codigos_collection = almacen.coleccion('codigos')
+links_collection = almacen.coleccion('links')
+paginas_collection = almacen.coleccion('paginas')
+historial_rifa_collection = almacen.coleccion('historial_rifa')
+historial_gratis_collection = almacen.coleccion('historial_gratis')
+comprobantes_pendientes_collection = almacen.coleccion('comprobantes_pendientes')
+comprobantes_archivados_collection = almacen.coleccion('comprobantes_archivados')
+contadores_collection = almacen.coleccion('contadores')
+participaciones_collection = almacen.coleccion('participaciones')
+
+# Escrituras diferidas: los handlers no esperan a la base de datos
+cola_escritura = ColaEscritura(
+    almacen,
+    os.getenv('ESCRITURA_DIARIO', 'escrituras.diario'),
+    intervalo=float(os.getenv('ESCRITURA_INTERVALO', '0.5'))
 )
-db = client[os.getenv('MONGODB_DB_NAME')]
-
-# Colecciones de MongoDB
-registro_collection = db.registro
-compras_collection = db.compras
-ganadores_collection = db.ganadores
-gratis_collection = db.gratis
-codigos_collection = db.codigos
-links_collection = db.links
-historial_rifa_collection = db.historial_rifa
-historial_gratis_collection = db.historial_gratis
-comprobantes_pendientes_collection = db.comprobantes_pendientes
 
 # Inicializar el bot
 bot = TeleBot(TOKEN)
@@ -67,28 +92,16 @@ RETRY_DELAY = int(os.getenv('RETRY_DELAY'))
 # Constantes para directorios
 CONVERSACIONES_DIR = 'conversaciones'
 
-# Funciones de MongoDB
-def inicializar_mongodb():
-    """Inicializa las colecciones de MongoDB con sus estructuras base"""
-    # Inicializar registro
-    if registro_collection.count_documents({}) == 0:
-        registro_collection.insert_one({'usuarios': []})
-    
-    # Inicializar compras
-    if compras_collection.count_documents({}) == 0:
-        compras_collection.insert_one({'compras': []})
-    
-    # Inicializar ganadores
-    if ganadores_collection.count_documents({}) == 0:
-        ganadores_collection.insert_one({'ganadores': []})
-    
-    # Inicializar gratis
-    if gratis_collection.count_documents({}) == 0:
-        gratis_collection.insert_one({'participantes': []})
+# Funciones de almacenamiento
+def inicializar_almacenamiento():
+    """Inicializa las colecciones con sus estructuras base"""
+    # Registro, compras, ganadores, gratis y comprobantes usan un documento por registro
+    # y los historiales una partición por sorteo
+    almacen.migrar()
     
     # Inicializar códigos
-    if codigos_collection.count_documents({}) == 0:
-        codigos_collection.insert_one({
+    if contar_registros(codigos_collection) == 0:
+        insertar_documento(codigos_collection, {
             'codigos_disponibles': [],
             'codigos_usados': [],
             'codigos_activos': {},
@@ -100,49 +113,87 @@ def inicializar_mongodb():
             }
         })
     
-    # Inicializar links
-    if links_collection.count_documents({}) == 0:
-        links_collection.insert_one({'links': []})
-    
-    # Inicializar historiales
-    if historial_rifa_collection.count_documents({}) == 0:
-        historial_rifa_collection.insert_one({'historial': {}})
-    if historial_gratis_collection.count_documents({}) == 0:
-        historial_gratis_collection.insert_one({'historial': {}})
+    # Las páginas y sus links están en el registro de páginas (los links antiguos se migran)
+    migrar_paginas(paginas_collection, codigos_collection, links_collection)
     
-    # Inicializar comprobantes pendientes
-    if comprobantes_pendientes_collection.count_documents({}) == 0:
-        comprobantes_pendientes_collection.insert_one({'comprobantes': []})
-
-def cargar_datos(coleccion, campo=None):
-    """Carga datos de una colección de MongoDB"""
-    try:
-        if campo:
-            documento = coleccion.find_one({})
-            if documento is None:
-                # Si no hay documento, devolver un valor por defecto según el campo
-                if campo in ['compras', 'participantes', 'links']:
-                    return []
-                elif campo == 'historial':
-                    return {}
-                else:
-                    return {}
-            
-            valor = documento.get(campo)
-            # Asegurarse de que el valor sea del tipo correcto
-            if campo in ['compras', 'participantes', 'links'] and not isinstance(valor, list):
+    # Recalcular el contador de comprobantes pendientes (antes de reaplicar la cola de escritura)
+    fijar_contador(contadores_collection, 'comprobantes_pendientes',
+                   contar_registros(comprobantes_pendientes_collection, {'estado': 'pendiente'}))
+
+# Estados finales: el comprobante ya no se necesita en la cola de pendientes
+ESTADOS_FINALES_COMPROBANTE = ('completado', 'rechazado')
+# Un comprobante verificado espera la cantidad de boletos del administrador; si pasado
+# este tiempo sigue así, se abandonó y también se archiva
+ESPERA_ARCHIVO_VERIFICADO = timedelta(days=1)
+INTERVALO_ARCHIVO_COMPROBANTES = int(os.getenv('INTERVALO_ARCHIVO_COMPROBANTES', 3600))
+
+def archivar_comprobantes():
+    """Mueve los comprobantes terminados a comprobantes_archivados"""
+    cola_escritura.sincronizar(comprobantes_pendientes_collection.name)
+    archivados = 0
+    for estado in ESTADOS_FINALES_COMPROBANTE:
+        archivados += mover_registros(
+            comprobantes_pendientes_collection, comprobantes_archivados_collection, {'estado': estado}) or 0
+
+    # Los verificados son pocos (solo los que esperan la cantidad): se revisa su antigüedad
+    limite = (datetime.now() - ESPERA_ARCHIVO_VERIFICADO).strftime('%Y-%m-%d %H:%M:%S')
+    for comprobante in cargar_registros(comprobantes_pendientes_collection, {'estado': 'verificado'}):
+        if comprobante.get('fecha_creacion', '') < limite:
+            archivados += mover_registros(
+                comprobantes_pendientes_collection, comprobantes_archivados_collection,
+                {'comprobante_id': comprobante['comprobante_id'], 'estado': 'verificado'}) or 0
+    return archivados
+
+def archivar_comprobantes_periodicamente():
+    """Archiva los comprobantes terminados cada INTERVALO_ARCHIVO_COMPROBANTES segundos"""
+    while True:
+        try:
+            archivados = archivar_comprobantes()
+            if archivados:
+                print(f"Archivados {archivados} comprobantes terminados")
+        except Exception as e:
+            print(f"Error al archivar comprobantes: {e}")
+        time.sleep(INTERVALO_ARCHIVO_COMPROBANTES)
+
+def _leer_datos(coleccion, campo=None):
+    """Lee datos directamente del almacenamiento"""
+    if campo in CAMPOS_POR_REGISTRO:
+        return cargar_registros(coleccion)
+    if campo == 'historial':
+        return cargar_historial(coleccion)
+    if campo:
+        documento = cargar_documento(coleccion)
+        if documento is None:
+            # Si no hay documento, devolver un valor por defecto según el campo
+            if campo in ['compras', 'participantes', 'links']:
                 return []
-            elif campo == 'historial' and not isinstance(valor, dict):
+            elif campo == 'historial':
                 return {}
-            return valor
-        else:
-            documento = coleccion.find_one({})
-            if documento is None:
+            else:
                 return {}
-            return documento
+        
+        valor = documento.get(campo)
+        # Asegurarse de que el valor sea del tipo correcto
+        if campo in ['compras', 'participantes', 'links'] and not isinstance(valor, list):
+            return []
+        elif campo == 'historial' and not isinstance(valor, dict):
+            return {}
+        return valor
+    else:
+        documento = cargar_documento(coleccion)
+        if documento is None:
+            return {}
+        return documento
+
+def cargar_datos(coleccion, campo=None):
+    """Carga datos de una colección pasando por la caché de lectura"""
+    try:
+        # Guardar antes lo que haya en la cola para esta colección
+        cola_escritura.sincronizar(coleccion.name)
+        return leer_con_cache(coleccion, campo, lambda: _leer_datos(coleccion, campo))
     except Exception as e:
         print(f"Error al cargar datos de {coleccion.name}: {e}")
-        if campo in ['compras', 'participantes', 'links']:
+        if campo in CAMPOS_POR_REGISTRO or campo == 'links':
             return []
         elif campo == 'historial':
             return {}
@@ -150,53 +201,40 @@ def cargar_datos(coleccion, campo=None):
             return {}
 
 def guardar_datos(coleccion, datos, campo=None):
-    """Guarda datos en una colección de MongoDB"""
-    try:
-        # Primero eliminar todos los documentos existentes
-        coleccion.delete_many({})
-        
-        # Luego insertar los nuevos datos
-        if campo:
-            coleccion.insert_one({campo: datos})
-        else:
-            coleccion.insert_one(datos)
-        return True
-    except Exception as e:
-        print(f"Error al guardar datos en {coleccion.name}: {e}")
-        return False
+    """Guarda datos en una colección"""
+    cola_escritura.sincronizar(coleccion.name)
+    if campo in CAMPOS_POR_REGISTRO:
+        # Reemplazo atómico: los lectores nunca ven la colección vacía
+        return reemplazar_registros(coleccion, datos)
+    
+    # Reemplazar el documento único de la colección
+    if campo:
+        return guardar_documento(coleccion, {campo: datos})
+    return guardar_documento(coleccion, datos)
+
+def archivar_rifa(coleccion, historial, fecha):
+    """Mueve la rifa actual al historial dentro de la base de datos y devuelve cuántos registros movió"""
+    # Incluir lo que aún esté en la cola de escritura
+    cola_escritura.sincronizar(coleccion.name)
+    return archivar_registros(coleccion, historial, fecha) or 0
 
 def mover_datos_a_historial():
     """Mueve los datos actuales a las colecciones de historial"""
-    # Mover datos de rifas pagadas
-    compras = cargar_datos(compras_collection, 'compras')
-    historial_rifas = cargar_datos(historial_rifa_collection, 'historial')
     fecha_actual = datetime.now().strftime('%Y-%m-%d')
     
-    # Asegurarse de que historial_rifas sea un diccionario
-    if not isinstance(historial_rifas, dict):
-        historial_rifas = {}
-    
-    if compras:
-        historial_rifas[fecha_actual] = compras
-        guardar_datos(historial_rifa_collection, historial_rifas, 'historial')
-        guardar_datos(compras_collection, [], 'compras')
+    # Mover datos de rifas pagadas
+    archivar_rifa(compras_collection, historial_rifa_collection, fecha_actual)
     
     # Mover datos de rifas gratis
-    gratis = cargar_datos(gratis_collection, 'participantes')
-    historial_gratis = cargar_datos(historial_gratis_collection, 'historial')
-    
-    # Asegurarse de que historial_gratis sea un diccionario
-    if not isinstance(historial_gratis, dict):
-        historial_gratis = {}
-    
-    if gratis:
-        historial_gratis[fecha_actual] = gratis
-        guardar_datos(historial_gratis_collection, historial_gratis, 'historial')
-        guardar_datos(gratis_collection, [], 'participantes')
+    archivar_rifa(gratis_collection, historial_gratis_collection, fecha_actual)
 
-# Generar número único
-def generar_numero_unico():
-    return str(uuid.uuid4())
+# Reservar números de boleto
+def reservar_boletos(cantidad):
+    """Reserva números de boleto consecutivos con un solo incremento del contador"""
+    ultimo = reservar_secuencia(contadores_collection, 'boletos', cantidad)
+    if ultimo is None:
+        return None
+    return list(range(ultimo - cantidad + 1, ultimo + 1))
 
 # Generar QR
 def generar_qr(data, filename):
@@ -556,6 +594,9 @@ def start(message):
             "/lista - Ver todas las listas de rifas\n"
             "/descargar - Descargar archivos JSON\n"
             "/borrar_historial - Gestionar historial\n"
+            "/cache - Ver estadísticas de la caché\n"
+            "/pool - Ver estado del pool de conexiones\n"
+            "/stats - Ver estadísticas de códigos\n"
             "/gods - Iniciar chat con cliente específico\n\n"
             "📈 Estadísticas y Soporte:\n"
             "/cliente - Ver chat de soporte\n"
@@ -576,12 +617,9 @@ def start(message):
 @bot.message_handler(commands=['rifa'])
 def rifa(message):
     chat_id = message.chat.id
-    registro = cargar_datos(registro_collection, 'usuarios')
     
     # Verificar si el usuario ya está registrado
-    usuario_existente = None
-    if isinstance(registro, list):
-        usuario_existente = next((u for u in registro if u.get('chat_id') == chat_id), None)
+    usuario_existente = buscar_usuario(registro_collection, chat_id)
     
     if usuario_existente:
         markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
@@ -597,10 +635,10 @@ def procesar_opcion_rifa(message):
         bot.send_message(message.chat.id, "Por favor, ingrese su nombre completo:")
         bot.register_next_step_handler(message, pedir_nombre_rifa)
     else:
-        registro = cargar_datos(registro_collection, 'usuarios')
-        usuario = None
-        if isinstance(registro, list):
-            usuario = next((u for u in registro if u.get('nombre') == message.text), None)
+        # El nombre elegido debe ser el registrado para este chat
+        usuario = buscar_usuario(registro_collection, message.chat.id)
+        if usuario and usuario.get('nombre') != message.text:
+            usuario = None
             
         if usuario:
             # Auto-rellenar celular y continuar con el proceso
@@ -660,20 +698,13 @@ def pedir_celular_rifa(message, nombre):
     else:
         chat_id = message.chat.id
         
-        # Guardar en registro
-        registro = cargar_datos(registro_collection, 'usuarios')
-        
-        # Eliminar cualquier registro existente con el mismo chat_id
-        registro = [u for u in registro if u.get('chat_id') != chat_id]
-        
-        # Agregar el nuevo registro
-        registro.append({
+        # Guardar en registro (reemplaza cualquier registro con el mismo chat_id)
+        cola_escritura.guardar_usuario(registro_collection, {
             'nombre': nombre,
             'celular': celular,
             'chat_id': chat_id,
             'fecha_registro': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         })
-        guardar_datos(registro_collection, registro, 'usuarios')
         
         # Enviar instrucciones de pago
         bot.send_message(chat_id, 
@@ -721,12 +752,9 @@ def procesar_comprobante_rifa(message, nombre, celular):
             'fecha_creacion': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         }
         
-        # Obtener lista de comprobantes actual
-        comprobantes = cargar_datos(comprobantes_pendientes_collection, 'comprobantes')
-        
-        # Añadir nuevo comprobante y guardar
-        comprobantes.append(nuevo_comprobante)
-        guardar_datos(comprobantes_pendientes_collection, comprobantes, 'comprobantes')
+        # Guardar el nuevo comprobante como un documento propio y contarlo como pendiente
+        cola_escritura.agregar_registro(comprobantes_pendientes_collection, nuevo_comprobante)
+        cola_escritura.incrementar_contador(contadores_collection, 'comprobantes_pendientes')
         
         # Enviar foto con botones al admin
         bot.send_photo(
@@ -751,27 +779,22 @@ def manejar_verificacion(call):
         _, decision, chat_id, comprobante_id = call.data.split('_')
         chat_id = int(chat_id)
         
-        # Obtener comprobantes pendientes
-        comprobantes = cargar_datos(comprobantes_pendientes_collection, 'comprobantes')
+        # El comprobante puede seguir en la cola de escritura
+        cola_escritura.sincronizar(comprobantes_pendientes_collection.name)
         
-        # Buscar el comprobante específico
-        indice_comprobante = next((i for i, c in enumerate(comprobantes) if c['comprobante_id'] == comprobante_id), None)
+        # Cambiar el estado solo si el comprobante sigue pendiente
+        nuevo_estado = 'verificado' if decision == 'si' else 'rechazado'
+        comprobante = actualizar_estado_comprobante(
+            comprobantes_pendientes_collection, comprobante_id, nuevo_estado, estado_anterior='pendiente')
         
-        if indice_comprobante is not None:
-            comprobante = comprobantes[indice_comprobante]
+        if comprobante is not None:
+            # Un pendiente menos: el contador devuelve los que quedan sin recorrer la colección
+            pendientes = descontar_contador(contadores_collection, 'comprobantes_pendientes')
             
             if decision == 'si':
-                # Actualizar estado del comprobante
-                comprobantes[indice_comprobante]['estado'] = 'verificado'
-                guardar_datos(comprobantes_pendientes_collection, comprobantes, 'comprobantes')
-                
                 bot.send_message(ADMIN_CHAT_ID, "¿Cuántos boletos está comprando?")
                 bot.register_next_step_handler(call.message, procesar_cantidad_boletos, comprobante)
             else:
-                # Actualizar estado del comprobante
-                comprobantes[indice_comprobante]['estado'] = 'rechazado'
-                guardar_datos(comprobantes_pendientes_collection, comprobantes, 'comprobantes')
-                
                 bot.send_message(comprobante['chat_id'], 
                     "Lo sentimos, su comprobante no fue verificado como auténtico. "
                     "Por favor, intente nuevamente con un comprobante válido.")
@@ -784,9 +807,10 @@ def manejar_verificacion(call):
             )
             
             # Mostrar mensaje de cuántos comprobantes quedan pendientes
-            pendientes = sum(1 for c in comprobantes if c['estado'] == 'pendiente')
-            if pendientes > 0:
+            if (pendientes or 0) > 0:
                 bot.send_message(ADMIN_CHAT_ID, f"Quedan {pendientes} comprobantes pendientes de verificar.")
+        else:
+            bot.answer_callback_query(call.id, "Este comprobante ya fue procesado.")
     else:
         bot.answer_callback_query(call.id, "No tienes permisos para verificar comprobantes.")
 
@@ -811,12 +835,15 @@ def procesar_cantidad_boletos(message, datos_temp):
                 "Ejemplo: 1, 2, 3, etc.")
             bot.register_next_step_handler(message, procesar_cantidad_boletos, datos_temp)
         else:
-            # Generar números únicos
-            numeros_unicos = [generar_numero_unico() for _ in range(cantidad)]
+            # Reservar los números de boleto con un solo incremento
+            numeros_unicos = reservar_boletos(cantidad)
+            if numeros_unicos is None:
+                bot.send_message(ADMIN_CHAT_ID, "❌ Error al reservar los boletos. Ingrese la cantidad nuevamente.")
+                bot.register_next_step_handler(message, procesar_cantidad_boletos, datos_temp)
+                return
             
             # Guardar compra
-            compras = cargar_datos(compras_collection, 'compras')
-            compras.append({
+            cola_escritura.agregar_registro(compras_collection, {
                 'nombre': datos_temp['nombre'],
                 'celular': datos_temp['celular'],
                 'chat_id': datos_temp['chat_id'],
@@ -825,18 +852,13 @@ def procesar_cantidad_boletos(message, datos_temp):
                 'fecha_compra': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
                 'comprobante_id': datos_temp['comprobante_id']
             })
-            guardar_datos(compras_collection, compras, 'compras')
             
-            # Actualizar estado del comprobante a completado en la lista
-            comprobantes = cargar_datos(comprobantes_pendientes_collection, 'comprobantes')
-            indice_comprobante = next((i for i, c in enumerate(comprobantes) if c['comprobante_id'] == datos_temp['comprobante_id']), None)
-            
-            if indice_comprobante is not None:
-                comprobantes[indice_comprobante]['estado'] = 'completado'
-                guardar_datos(comprobantes_pendientes_collection, comprobantes, 'comprobantes')
+            # Actualizar estado del comprobante a completado
+            cola_escritura.actualizar_estado_comprobante(
+                comprobantes_pendientes_collection, datos_temp['comprobante_id'], 'completado')
             
             # Generar y enviar QR
-            qr_data = f"Números Únicos:\n{', '.join(numeros_unicos)}\nNombre: {datos_temp['nombre']}\nCelular: {datos_temp['celular']}"
+            qr_data = f"Números Únicos:\n{formatear_boletos(numeros_unicos)}\nNombre: {datos_temp['nombre']}\nCelular: {datos_temp['celular']}"
             qr_filename = f"qr_{datos_temp['chat_id']}.png"
             generar_qr(qr_data, qr_filename)
             
@@ -850,7 +872,7 @@ def procesar_cantidad_boletos(message, datos_temp):
                 f"🎉 ¡Gracias por tu compra, {datos_temp['nombre']}!\n\n"
                 f"📋 Detalles de tu compra:\n"
                 f"- Cantidad de boletos: {cantidad}\n"
-                f"- Números únicos: {', '.join(numeros_unicos)}\n\n"
+                f"- Números únicos: {formatear_boletos(numeros_unicos)}\n\n"
                 "🎯 Tus números únicos están en el código QR adjunto.\n"
                 "🍀 ¡Participa nuevamente para aumentar tus chances de ganar!")
     except ValueError:
@@ -865,20 +887,13 @@ def procesar_cantidad_boletos(message, datos_temp):
 def gratis(message):
     chat_id = message.chat.id
     
-    # Verificar si el usuario ya participó hoy
-    gratis = cargar_datos(gratis_collection, 'participantes')
-    hoy = datetime.now().strftime('%Y-%m-%d')
-    participacion_hoy = any(g['chat_id'] == chat_id and g['fecha_registro'].startswith(hoy) for g in gratis)
-    
-    if participacion_hoy:
-        bot.send_message(chat_id, 
-            "❌ Ya has participado hoy en la rifa gratis.\n\n"
-            "Por favor, vuelve mañana para participar nuevamente.\n"
-            "¡Gracias por tu interés! 🎉")
+    # Verificar si el usuario ya participó hoy (en memoria)
+    if ya_participo(participaciones_collection, chat_id):
+        avisar_participacion_repetida(chat_id)
         return
     
-    # Obtener links disponibles
-    links = cargar_datos(links_collection, 'links')
+    # Obtener links de las páginas activas
+    links = [p['link'] for p in cargar_paginas(paginas_collection) if p.get('link')]
     if not links:
         bot.send_message(chat_id, 
             "❌ Lo sentimos, no hay páginas disponibles en este momento.\n"
@@ -894,53 +909,71 @@ def gratis(message):
     bot.send_message(chat_id, mensaje)
     bot.register_next_step_handler(message, verificar_codigo_gratis)
 
+def avisar_participacion_repetida(chat_id):
+    bot.send_message(chat_id, 
+        "❌ Ya has participado hoy en la rifa gratis.\n\n"
+        "Por favor, vuelve mañana para participar nuevamente.\n"
+        "¡Gracias por tu interés! 🎉")
+
+def registrar_participacion_gratis(chat_id):
+    """Registra la participación de hoy; avisa al usuario y devuelve False si no procede"""
+    registrada = registrar_participacion(participaciones_collection, chat_id)
+    if registrada is None:
+        bot.send_message(chat_id, "❌ Error al registrar tu participación. Por favor, intente nuevamente con /gratis.")
+    elif not registrada:
+        avisar_participacion_repetida(chat_id)
+    return bool(registrada)
+
+def reservar_boleto_gratis(chat_id):
+    """Reserva el boleto gratis de hoy y registra la participación; None si no procede"""
+    if ya_participo(participaciones_collection, chat_id):
+        avisar_participacion_repetida(chat_id)
+        return None
+    boletos = reservar_boletos(1)
+    if boletos is None:
+        bot.send_message(chat_id, "❌ Error al generar tu número. Por favor, intente nuevamente con /gratis.")
+        return None
+    # La participación se registra después de reservar: si la reserva falla el usuario
+    # puede volver a intentarlo hoy (una reserva sin participación solo deja un número sin usar)
+    if not registrar_participacion_gratis(chat_id):
+        return None
+    return boletos[0]
+
 def validar_codigo(codigo):
-    """Valida un código y actualiza su estado"""
+    """Devuelve el número de la página que muestra el código ahora, o None si no es válido"""
     try:
-        # Cargar datos de la base de datos
-        datos = codigos_collection.find_one()
-        if not datos:
-            print("Error: No se encontraron datos en la base de datos")
-            return False
-            
-        # Verificar si el código está activo en la página 1
-        codigos_activos = datos.get('codigos_activos', {})
-        if codigos_activos.get('pagina1', {}).get('codigo') == codigo:
-            return True
-            
-        return False
+        # Búsqueda directa código -> página, vale para cualquier número de páginas
+        return pagina_de_codigo(paginas_collection, codigo)
     except Exception as e:
         print(f"Error al validar código: {e}")
-        return False
+        return None
 
 def verificar_codigo_gratis(message):
     try:
         chat_id = message.chat.id
         codigo = message.text.strip()
         
-        # Validar el código
-        if validar_codigo(codigo):
+        # Validar el código y saber de qué página salió
+        pagina = validar_codigo(codigo)
+        if pagina:
             # Verificar si el usuario ya está registrado
-            registro = cargar_datos(registro_collection, 'usuarios')
-            usuario_existente = None
-            if isinstance(registro, list):
-                usuario_existente = next((u for u in registro if u.get('chat_id') == chat_id), None)
+            usuario_existente = buscar_usuario(registro_collection, chat_id)
             
             if usuario_existente:
                 markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
                 markup.add(usuario_existente.get('nombre', ''), "Otro")
                 bot.send_message(chat_id, "¿Desea usar su nombre registrado o registrar uno nuevo?", reply_markup=markup)
-                bot.register_next_step_handler(message, procesar_opcion_gratis, codigo)
+                bot.register_next_step_handler(message, procesar_opcion_gratis, codigo, pagina)
             else:
                 bot.send_message(chat_id, "Por favor, ingrese su nombre completo:")
-                bot.register_next_step_handler(message, pedir_nombre_gratis, codigo)
+                bot.register_next_step_handler(message, pedir_nombre_gratis, codigo, pagina)
         else:
             bot.send_message(chat_id, 
                 "❌ Código no válido o expirado.\n"
                 "Razones posibles:\n"
                 "- El código no existe\n"
                 "- El código ya está en uso\n"
-                "- El código no está activo en la página 1\n\n"
+                "- El código ya no está activo en ninguna página\n\n"
                 "Por favor, intente con otro código o visite nuestras páginas web para obtener uno nuevo.")
             bot.register_next_step_handler(message, verificar_codigo_gratis)
         
@@ -949,15 +982,15 @@ def verificar_codigo_gratis(message):
         bot.send_message(chat_id, "❌ Error al verificar el código. Por favor, intente nuevamente.")
         bot.register_next_step_handler(message, verificar_codigo_gratis)
 
-def procesar_opcion_gratis(message, codigo):
+def procesar_opcion_gratis(message, codigo, pagina=None):
     if message.text == "Otro":
         bot.send_message(message.chat.id, "Por favor, ingrese su nombre completo:")
-        bot.register_next_step_handler(message, pedir_nombre_gratis, codigo)
+        bot.register_next_step_handler(message, pedir_nombre_gratis, codigo, pagina)
     else:
-        registro = cargar_datos(registro_collection, 'usuarios')
-        usuario = None
-        if isinstance(registro, list):
-            usuario = next((u for u in registro if u.get('nombre') == message.text), None)
+        # El nombre elegido debe ser el registrado para este chat
+        usuario = buscar_usuario(registro_collection, message.chat.id)
+        if usuario and usuario.get('nombre') != message.text:
+            usuario = None
             
         if usuario:
             # Auto-rellenar celular y continuar con el proceso
@@ -965,23 +998,24 @@ def procesar_opcion_gratis(message, codigo):
             nombre = usuario.get('nombre', '')
             celular = usuario.get('celular', '')
             
-            # Generar número único
-            numero_unico = generar_numero_unico()
+            # Una sola participación por día, aunque llegue dos veces a la vez
+            numero_unico = reservar_boleto_gratis(chat_id)
+            if numero_unico is None:
+                return
             
             # Guardar en registro de rifas gratis
-            gratis = cargar_datos(gratis_collection, 'participantes')
-            gratis.append({
+            cola_escritura.agregar_registro(gratis_collection, {
                 'nombre': nombre,
                 'celular': celular,
                 'chat_id': chat_id,
                 'numero_unico': numero_unico,
                 'codigo': codigo,
+                'pagina': pagina,
                 'fecha_registro': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             })
-            guardar_datos(gratis_collection, gratis, 'participantes')
             
             # Generar y enviar QR
-            qr_data = f"Número Único: {numero_unico}\nNombre: {nombre}\nCelular: {celular}"
+            qr_data = f"Número Único: {formatear_boleto(numero_unico)}\nNombre: {nombre}\nCelular: {celular}"
             qr_filename = f"qr_gratis_{chat_id}.png"
             generar_qr(qr_data, qr_filename)
             
@@ -998,12 +1032,12 @@ def procesar_opcion_gratis(message, codigo):
                 "¡Buena suerte! 🍀")
         else:
             bot.send_message(message.chat.id, "Usuario no encontrado. Por favor, ingrese su nombre completo:")
-            bot.register_next_step_handler(message, pedir_nombre_gratis, codigo)
+            bot.register_next_step_handler(message, pedir_nombre_gratis, codigo, pagina)
 
-def pedir_nombre_gratis(message, codigo):
+def pedir_nombre_gratis(message, codigo, pagina=None):
     if not message or not message.text:
         bot.send_message(message.chat.id, "Por favor, ingrese su nombre completo (nombre y apellido).")
-        bot.register_next_step_handler(message, pedir_nombre_gratis, codigo)
+        bot.register_next_step_handler(message, pedir_nombre_gratis, codigo, pagina)
         return
     
     nombre = message.text.strip()
@@ -1012,15 +1046,15 @@ def pedir_nombre_gratis(message, codigo):
             "❌ Error: El nombre debe contener al menos nombre y apellido.\n\n"
             "Por favor, ingrese su nombre completo.\n"
             "Ejemplo: Juan Pérez")
-        bot.register_next_step_handler(message, pedir_nombre_gratis, codigo)
+        bot.register_next_step_handler(message, pedir_nombre_gratis, codigo, pagina)
     else:
         bot.send_message(message.chat.id, "Por favor, ingrese su número de celular:")
-        bot.register_next_step_handler(message, pedir_celular_gratis, nombre, codigo)
+        bot.register_next_step_handler(message, pedir_celular_gratis, nombre, codigo, pagina)
 
-def pedir_celular_gratis(message, nombre, codigo):
+def pedir_celular_gratis(message, nombre, codigo, pagina=None):
     if not message or not message.text:
         bot.send_message(message.chat.id, "Por favor, ingrese su número de celular.")
-        bot.register_next_step_handler(message, pedir_celular_gratis, nombre, codigo)
+        bot.register_next_step_handler(message, pedir_celular_gratis, nombre, codigo, pagina)
         return
     
     celular = message.text.strip()
@@ -1029,48 +1063,42 @@ def pedir_celular_gratis(message, nombre, codigo):
             "❌ Error: El número de celular debe contener solo dígitos.\n\n"
             "Por favor, ingrese su número de celular correctamente.\n"
             "Ejemplo: 0991234567")
-        bot.register_next_step_handler(message, pedir_celular_gratis, nombre, codigo)
+        bot.register_next_step_handler(message, pedir_celular_gratis, nombre, codigo, pagina)
     elif len(celular) < 10:
         bot.send_message(message.chat.id, 
             "❌ Error: El número de celular debe tener al menos 10 dígitos.\n\n"
             "Por favor, ingrese su número de celular completo.\n"
             "Ejemplo: 0991234567")
-        bot.register_next_step_handler(message, pedir_celular_gratis, nombre, codigo)
+        bot.register_next_step_handler(message, pedir_celular_gratis, nombre, codigo, pagina)
     else:
         chat_id = message.chat.id
         
-        # Guardar en registro
-        registro = cargar_datos(registro_collection, 'usuarios')
-        
-        # Eliminar cualquier registro existente con el mismo chat_id
-        registro = [u for u in registro if u.get('chat_id') != chat_id]
-        
-        # Agregar el nuevo registro
-        registro.append({
+        # Guardar en registro (reemplaza cualquier registro con el mismo chat_id)
+        cola_escritura.guardar_usuario(registro_collection, {
             'nombre': nombre,
             'celular': celular,
             'chat_id': chat_id,
             'fecha_registro': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         })
-        guardar_datos(registro_collection, registro, 'usuarios')
         
-        # Generar número único
-        numero_unico = generar_numero_unico()
+        # Una sola participación por día, aunque llegue dos veces a la vez
+        numero_unico = reservar_boleto_gratis(chat_id)
+        if numero_unico is None:
+            return
         
         # Guardar en registro de rifas gratis
-        gratis = cargar_datos(gratis_collection, 'participantes')
-        gratis.append({
+        cola_escritura.agregar_registro(gratis_collection, {
             'nombre': nombre,
             'celular': celular,
             'chat_id': chat_id,
             'numero_unico': numero_unico,
             'codigo': codigo,
+            'pagina': pagina,
             'fecha_registro': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         })
-        guardar_datos(gratis_collection, gratis, 'participantes')
         
         # Generar y enviar QR
-        qr_data = f"Número Único: {numero_unico}\nNombre: {nombre}\nCelular: {celular}"
+        qr_data = f"Número Único: {formatear_boleto(numero_unico)}\nNombre: {nombre}\nCelular: {celular}"
         qr_filename = f"qr_gratis_{chat_id}.png"
         generar_qr(qr_data, qr_filename)
         
@@ -1182,7 +1210,7 @@ def procesar_opcion_descargar(message):
         
         # Obtener datos según la opción seleccionada
         if message.text == "Registro":
-            datos = cargar_datos(registro_collection)
+            datos = cargar_datos(registro_collection, 'usuarios')
             archivo = 'temp/registro.json'
         elif message.text == "Compras":
             datos = cargar_datos(compras_collection, 'compras')
@@ -1197,8 +1225,8 @@ def procesar_opcion_descargar(message):
             datos = cargar_datos(codigos_collection)
             archivo = 'temp/codigos.json'
         elif message.text == "Links":
-            datos = cargar_datos(links_collection, 'links')
-            archivo = 'temp/links.json'
+            datos = cargar_registros(paginas_collection)
+            archivo = 'temp/paginas.json'
         elif message.text == "Historial Pagas":
             datos = cargar_datos(historial_rifa_collection, 'historial')
             archivo = 'temp/historial_pagas.json'
@@ -1211,7 +1239,7 @@ def procesar_opcion_descargar(message):
         
         # Guardar datos en archivo temporal
         with open(archivo, 'w', encoding='utf-8') as f:
-            json.dump(datos, f, ensure_ascii=False, indent=4)
+            json.dump(datos, f, ensure_ascii=False, indent=4, default=str)
         
         # Enviar archivo
         with open(archivo, 'rb') as f:
@@ -1227,6 +1255,54 @@ def procesar_opcion_descargar(message):
     except Exception as e:
         bot.send_message(message.chat.id, f"❌ Error al descargar el archivo: {str(e)}")
 
+# Comando /cache (solo admin)
+@bot.message_handler(commands=['cache'])
+def cache(message):
+    if message.chat.id == ADMIN_CHAT_ID:
+        aciertos = estadisticas_cache['aciertos']
+        fallos = estadisticas_cache['fallos']
+        total = aciertos + fallos
+        porcentaje = (aciertos / total * 100) if total else 0
+        bot.send_message(message.chat.id,
+            f"📊 Estadísticas de la caché:\n\n"
+            f"✅ Aciertos: {aciertos}\n"
+            f"❌ Fallos: {fallos}\n"
+            f"🔄 Invalidaciones: {estadisticas_cache['invalidaciones']}\n"
+            f"📈 Tasa de aciertos: {porcentaje:.1f}%\n"
+            f"📝 Escrituras en cola: {cola_escritura.pendientes()}")
+    else:
+        bot.send_message(message.chat.id, "No tiene permisos para usar este comando.")
+
+# Comando /pool (solo admin)
+@bot.message_handler(commands=['pool'])
+def pool(message):
+    if message.chat.id == ADMIN_CHAT_ID:
+        metricas = estadisticas_pool()
+        bot.send_message(message.chat.id,
+            f"🔌 Pool de conexiones de MongoDB:\n\n"
+            f"🔗 Abiertas: {metricas['abiertas']}\n"
+            f"⚙️ En uso: {metricas['en_uso']} (máximo {metricas['max_en_uso']})\n"
+            f"⏳ Esperando conexión: {metricas['esperando']}\n"
+            f"⏱ Espera media: {metricas['espera_media_ms']:.1f} ms (máxima {metricas['espera_max_ms']:.1f} ms)\n"
+            f"❌ Checkouts fallidos: {metricas['checkouts_fallidos']}")
+    else:
+        bot.send_message(message.chat.id, "No tiene permisos para usar este comando.")
+
+# Comando /stats (solo admin)
+@bot.message_handler(commands=['stats'])
+def stats(message):
+    if message.chat.id == ADMIN_CHAT_ID:
+        # Solo se leen los contadores, no se recorren las colecciones de códigos
+        estadisticas = leer_estadisticas_codigos(contadores_collection)
+        bot.send_message(message.chat.id,
+            f"🔢 Estadísticas de códigos:\n\n"
+            f"✅ Disponibles: {estadisticas['disponibles']}\n"
+            f"⏳ En espera: {estadisticas['usados']}\n"
+            f"🆕 Generados: {estadisticas['generados']}\n"
+            f"📄 Asignados a páginas: {estadisticas['asignados']}")
+    else:
+        bot.send_message(message.chat.id, "No tiene permisos para usar este comando.")
+
 # Comando /borrar_historial (solo admin)
 @bot.message_handler(commands=['borrar_historial'])
 def borrar_historial(message):
@@ -1245,59 +1321,36 @@ def procesar_opcion_borrar(message):
     try:
         if message.text == "Rifas Pagadas":
             # Mover datos actuales al historial
-            compras = cargar_datos(compras_collection, 'compras')
-            historial_rifas = cargar_datos(historial_rifa_collection, 'historial')
             fecha_actual = datetime.now().strftime('%Y-%m-%d')
             
-            if compras:
-                # Verificar si ya existe un historial para esta fecha
-                if fecha_actual in historial_rifas:
-                    # Si existe, agregar los nuevos datos a los existentes
-                    historial_rifas[fecha_actual].extend(compras)
-                else:
-                    # Si no existe, crear una nueva entrada
-                    historial_rifas[fecha_actual] = compras
-                
-                guardar_datos(historial_rifa_collection, historial_rifas, 'historial')
-                guardar_datos(compras_collection, [], 'compras')
+            if archivar_rifa(compras_collection, historial_rifa_collection, fecha_actual):
                 bot.send_message(message.chat.id, "✅ Historial de rifas pagadas borrado exitosamente.")
             else:
                 bot.send_message(message.chat.id, "No hay datos de rifas pagadas para borrar.")
         
         elif message.text == "Rifas Gratis":
             # Mover datos actuales al historial
-            gratis = cargar_datos(gratis_collection, 'participantes')
-            historial_gratis = cargar_datos(historial_gratis_collection, 'historial')
             fecha_actual = datetime.now().strftime('%Y-%m-%d')
             
-            if gratis:
-                # Verificar si ya existe un historial para esta fecha
-                if fecha_actual in historial_gratis:
-                    # Si existe, agregar los nuevos datos a los existentes
-                    historial_gratis[fecha_actual].extend(gratis)
-                else:
-                    # Si no existe, crear una nueva entrada
-                    historial_gratis[fecha_actual] = gratis
-                
-                guardar_datos(historial_gratis_collection, historial_gratis, 'historial')
-                guardar_datos(gratis_collection, [], 'participantes')
+            if archivar_rifa(gratis_collection, historial_gratis_collection, fecha_actual):
                 bot.send_message(message.chat.id, "✅ Historial de rifas gratis borrado exitosamente.")
             else:
                 bot.send_message(message.chat.id, "No hay datos de rifas gratis para borrar.")
         
         elif message.text == "Historial Pagas":
             # Borrar historial de rifas pagadas completamente
-            guardar_datos(historial_rifa_collection, {'historial': {}}, 'historial')
+            vaciar_historial(historial_rifa_collection)
             bot.send_message(message.chat.id, "✅ Historial de pagas borrado exitosamente.")
         
         elif message.text == "Historial Gratis":
             # Borrar historial de rifas gratis completamente
-            guardar_datos(historial_gratis_collection, {'historial': {}}, 'historial')
+            vaciar_historial(historial_gratis_collection)
             bot.send_message(message.chat.id, "✅ Historial de gratis borrado exitosamente.")
         
         elif message.text == "Registros":
-            # Borrar registros de usuarios
-            guardar_datos(registro_collection, {'usuarios': []}, 'usuarios')
+            # Borrar registros de usuarios (después de guardar los que estén en cola)
+            cola_escritura.sincronizar(registro_collection.name)
+            eliminar_usuarios(registro_collection)
             bot.send_message(message.chat.id, "✅ Registros de usuarios borrados exitosamente.")
         
         elif message.text == "Todo":
@@ -1322,6 +1375,10 @@ def qe(message):
     else:
         bot.send_message(message.chat.id, "No tiene permisos para usar este comando.")
 
+def lista_paginas():
+    """Texto con el número y el link de cada página activa"""
+    return "\n".join(f"{p['numero']}. {p.get('link') or '(sin link)'}" for p in cargar_paginas(paginas_collection))
+
 def procesar_opcion_qe(message):
     if not message or not message.text:
         return
@@ -1329,18 +1386,16 @@ def procesar_opcion_qe(message):
         bot.send_message(message.chat.id, "Por favor, envíe el link completo (ejemplo: https://ejemplo.com):")
         bot.register_next_step_handler(message, agregar_link)
     elif message.text == "Eliminar Link":
-        links = cargar_datos(links_collection, 'links')
-        if links:
-            lista = "\n".join([f"{i+1}. {link}" for i, link in enumerate(links)])
-            bot.send_message(message.chat.id, f"Seleccione el número del link a eliminar:\n\n{lista}")
+        lista = lista_paginas()
+        if lista:
+            bot.send_message(message.chat.id, f"Seleccione el número de la página a eliminar:\n\n{lista}")
             bot.register_next_step_handler(message, eliminar_link)
         else:
             bot.send_message(message.chat.id, "No hay links registrados.")
     elif message.text == "Ver Links":
-        links = cargar_datos(links_collection, 'links')
-        if links:
-            lista = "\n".join([f"{i+1}. {link}" for i, link in enumerate(links)])
-            bot.send_message(message.chat.id, f"Lista de links:\n\n{lista}")
+        lista = lista_paginas()
+        if lista:
+            bot.send_message(message.chat.id, f"Lista de páginas:\n\n{lista}")
         else:
             bot.send_message(message.chat.id, "No hay links registrados.")
 
@@ -1349,13 +1404,17 @@ def agregar_link(message):
         return
     link = message.text.strip()
     if link.startswith('http://') or link.startswith('https://'):
-        links = cargar_datos(links_collection, 'links')
-        if link not in links:
-            links.append(link)
-            guardar_datos(links_collection, links, 'links')
-            bot.send_message(message.chat.id, "✅ Link agregado exitosamente.")
-        else:
+        if any(p.get('link') == link for p in cargar_paginas(paginas_collection)):
             bot.send_message(message.chat.id, "❌ Este link ya está registrado.")
+            return
+        # Como antes de tener el registro, el link va a la primera página que no tenga;
+        # solo si todas tienen se crea una página nueva, servida en /pagina<numero>
+        pagina = agregar_link_pagina(paginas_collection, link)
+        if pagina:
+            bot.send_message(message.chat.id,
+                f"✅ Link agregado exitosamente como página {pagina['numero']} (/pagina{pagina['numero']}).")
+        else:
+            bot.send_message(message.chat.id, "❌ Error al agregar el link.")
     else:
         bot.send_message(message.chat.id, "❌ Por favor, envíe un link válido que comience con http:// o https://")
 
@@ -1363,14 +1422,12 @@ def eliminar_link(message):
     if not message or not message.text:
         return
     try:
-        indice = int(message.text) - 1
-        links = cargar_datos(links_collection, 'links')
-        if 0 <= indice < len(links):
-            link_eliminado = links.pop(indice)
-            guardar_datos(links_collection, links, 'links')
-            bot.send_message(message.chat.id, f"✅ Link '{link_eliminado}' eliminado exitosamente.")
+        numero = int(message.text)
+        pagina = buscar_pagina(paginas_collection, numero, cache=False)
+        if pagina and desactivar_pagina(paginas_collection, numero):
+            bot.send_message(message.chat.id, f"✅ Página {numero} ('{pagina.get('link') or 'sin link'}') eliminada exitosamente.")
         else:
-            bot.send_message(message.chat.id, "❌ Número de link no válido.")
+            bot.send_message(message.chat.id, "❌ Número de página no válido.")
     except ValueError:
         bot.send_message(message.chat.id, "❌ Por favor, ingrese un número válido.")
 
@@ -1388,7 +1445,7 @@ def pi(message):
                 f"🎉 ¡Ganador de rifa gratuita seleccionado!\n\n"
                 f"👤 Nombre: {ganador['nombre']}\n"
                 f"📱 Celular: {ganador['celular']}\n"
-                f"🎫 Número único: {ganador['numero_unico']}")
+                f"🎫 Número único: {formatear_boleto(ganador['numero_unico'])}")
             
             # Notificar al ganador
             bot.send_message(ganador['chat_id'],
@@ -1399,7 +1456,7 @@ def pi(message):
             # Notificar a los demás participantes
             mensaje_participantes = (
                 f"🎯 ¡Tenemos un ganador!\n\n"
-                f"Felicitaciones a {ganador['nombre']}, quien ganó con el número único {ganador['numero_unico']}.\n\n"
+                f"Felicitaciones a {ganador['nombre']}, quien ganó con el número único {formatear_boleto(ganador['numero_unico'])}.\n\n"
                 "No te desanimes, ¡la próxima semana podrías ser tú!\n"
                 "Tenemos grandes sorpresas preparadas para los próximos sorteos. 🎁\n\n"
                 "Usa /gratis para participar en el próximo sorteo. 🍀"
@@ -1435,31 +1492,20 @@ def pi(message):
                     continue
             
             # Guardar en historial de ganadores
-            ganadores = cargar_datos(ganadores_collection, 'ganadores')
-            ganadores.append({
+            cola_escritura.agregar_registro(ganadores_collection, {
                 'nombre': ganador['nombre'],
                 'celular': ganador['celular'],
                 'chat_id': ganador['chat_id'],
                 'tipo': 'gratis',
                 'fecha': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             })
-            guardar_datos(ganadores_collection, ganadores, 'ganadores')
             
             # Mover datos actuales al historial
-            historial_gratis = cargar_datos(historial_gratis_collection, 'historial')
             fecha_actual = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             
-            if participantes:
-                # Verificar si ya existe un historial para esta fecha
-                if fecha_actual in historial_gratis:
-                    # Si existe, agregar los nuevos datos a los existentes
-                    historial_gratis[fecha_actual].extend(participantes)
-                else:
-                    # Si no existe, crear una nueva entrada
-                    historial_gratis[fecha_actual] = participantes
-                
-                guardar_datos(historial_gratis_collection, historial_gratis, 'historial')
-                guardar_datos(gratis_collection, [], 'participantes')
+            archivar_rifa(gratis_collection, historial_gratis_collection, fecha_actual)
+            # Con la rifa archivada, todos pueden participar en la siguiente aunque ya lo hicieran hoy
+            reiniciar_participaciones(participaciones_collection)
         else:
             bot.send_message(ADMIN_CHAT_ID, "❌ No hay participantes en rifas gratis registrados.")
     else:
@@ -1479,7 +1525,7 @@ def ganador(message):
                 f"🎉 ¡Ganador de rifa pagada seleccionado!\n\n"
                 f"👤 Nombre: {ganador['nombre']}\n"
                 f"📱 Celular: {ganador['celular']}\n"
-                f"🎫 Número único: {', '.join(ganador['numeros_unicos'])}")
+                f"🎫 Número único: {formatear_boletos(ganador['numeros_unicos'])}")
             
             # Notificar al ganador
             bot.send_message(ganador['chat_id'],
@@ -1526,31 +1572,18 @@ def ganador(message):
                     continue
             
             # Guardar en historial de ganadores
-            ganadores = cargar_datos(ganadores_collection, 'ganadores')
-            ganadores.append({
+            cola_escritura.agregar_registro(ganadores_collection, {
                 'nombre': ganador['nombre'],
                 'celular': ganador['celular'],
                 'chat_id': ganador['chat_id'],
                 'tipo': 'pagada',
                 'fecha': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             })
-            guardar_datos(ganadores_collection, ganadores, 'ganadores')
             
             # Mover datos actuales al historial
-            historial_rifas = cargar_datos(historial_rifa_collection, 'historial')
             fecha_actual = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             
-            if compras:
-                # Verificar si ya existe un historial para esta fecha
-                if fecha_actual in historial_rifas:
-                    # Si existe, agregar los nuevos datos a los existentes
-                    historial_rifas[fecha_actual].extend(compras)
-                else:
-                    # Si no existe, crear una nueva entrada
-                    historial_rifas[fecha_actual] = compras
-                
-                guardar_datos(historial_rifa_collection, historial_rifas, 'historial')
-                guardar_datos(compras_collection, [], 'compras')
+            archivar_rifa(compras_collection, historial_rifa_collection, fecha_actual)
         else:
             bot.send_message(ADMIN_CHAT_ID, "❌ No hay participantes en rifas pagadas registrados.")
     else:
@@ -1646,14 +1679,12 @@ def agregar_ganador_celular(message, nombre):
         bot.register_next_step_handler(message, agregar_ganador_celular, nombre)
     else:
         # Guardar ganador
-        ganadores = cargar_datos(ganadores_collection, 'ganadores')
-        ganadores.append({
+        cola_escritura.agregar_registro(ganadores_collection, {
             'nombre': nombre,
             'celular': celular,
             'tipo': 'manual',
             'fecha': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         })
-        guardar_datos(ganadores_collection, ganadores, 'ganadores')
         
         bot.send_message(message.chat.id, 
             f"✅ Ganador agregado exitosamente:\n\n"
@@ -2135,21 +2166,25 @@ def iniciar_bot_con_reintentos():
                 print("Se alcanzó el número máximo de reintentos. Saliendo...")
                 raise
 
-# Inicializar MongoDB
-inicializar_mongodb()
+# Inicializar almacenamiento
+inicializar_almacenamiento()
+cola_escritura.iniciar()
 
 # Iniciar el bot
 if __name__ == '__main__':
     print('Iniciando bot...')
     
-    # Verificar conexión a MongoDB
+    # Verificar conexión al almacenamiento
     try:
-        client.admin.command('ping')
-        print("✅ Conexión exitosa a MongoDB!")
+        almacen.ping()
+        print("✅ Conexión exitosa al almacenamiento!")
     except Exception as e:
-        print(f"❌ Error al conectar con MongoDB: {e}")
+        print(f"❌ Error al conectar con el almacenamiento: {e}")
         exit(1)
     
+    # Archivar comprobantes terminados en segundo plano
+    threading.Thread(target=archivar_comprobantes_periodicamente, daemon=True).start()
+    
     # Iniciar el bot con reintentos
     try:
         iniciar_bot_con_reintentos()